@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+"""
+Multi-flow fairness benchmark for foggy-TCP.
+
+Usage:
+  sudo python3 CP1_fairness.py --flow bin:reno --flow bin:cubic --flow system \\
+      --rate 10mbit --delay 10ms --size 10MB --stagger 2
+
+Each --flow is BIN_DIR[:CCA] (a directory holding a `client` and `server`,
+e.g. another team's build) or `system` for the kernel-TCP binaries built by
+`make system` and copied to bin/client-system and bin/server-system.
+
+This script:
+1. Puts one shared bottleneck (tbf rate limit, plus netem delay when the
+   kernel has it) on the loopback interface
+2. Starts one server and one client per flow, staggered, all on this host
+3. Samples each receiver's progress and the queueing delay seen by small
+   UDP probes crossing the same bottleneck
+4. Reports per-flow goodput, Jain's fairness index, queueing delay and
+   convergence time, and writes them to results/
+
+Everything runs over loopback so every receiver can be watched directly.
+Linux only.
+"""
+
+current_dir = Path(__file__).parent
+
+BIN_DIR = current_dir / "bin"
+output_dir = str(current_dir / "results")
+
+SERVER_IP = "127.0.0.1"
+BASE_PORT = 3200            # flow i listens on BASE_PORT + i
+PROBE_INTERVAL = 0.05       # seconds between queueing-delay probes
+SAMPLE_INTERVAL = 0.1       # seconds between progress samples
+FAIRNESS_WINDOW = 1.0       # seconds of traffic each Jain index covers
+CONVERGED_JAIN = 0.9        # Jain index a converged sharing must keep
+FLOW_TIMEOUT = 300          # seconds
+
+
+def parse_size(size):
+    """Convert a size such as 1KB, 10MB or 4096 to bytes."""
+    units = {"KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+    size = size.upper()
+    for suffix, scale in units.items():
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * scale)
+    return int(size)
+
+
+def parse_flow(spec, index):
+    """Turn a --flow argument into the binaries and environment to run."""
+    if spec == "system":
+        return {
+            "label": f"{index}:system",
+            "client": str(BIN_DIR / "client-system"),
+            "server": str(BIN_DIR / "server-system"),
+            "env": {},
+        }
+    bin_dir, _, cca = spec.partition(":")
+    bin_path = Path(bin_dir)
+    if not bin_path.is_absolute():
+        bin_path = current_dir / bin_path
+    env = {"FOGGY_CCA": cca} if cca else {}
+    return {
+        "label": f"{index}:{bin_path.name}:{cca or 'default'}",
+        "client": str(bin_path / "client"),
+        "server": str(bin_path / "server"),
+        "env": env,
+    }
+
+
+def apply_bottleneck(iface, rate, delay, queue_ms):
+    """Install a rate limit with an optional delay stage below it."""
+    cmd = ["tc", "qdisc", "replace", "dev", iface, "root", "handle", "1:",
+           "tbf", "rate", rate, "burst", "32kbit", "latency", f"{queue_ms}ms"]
+    if os.geteuid() != 0:
+        cmd = ["sudo"] + cmd
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"[ERROR] Failed to apply rate limit: {result.stderr.strip()}")
+        return False
+    print(f"[SHAPE] {rate} bottleneck with {queue_ms}ms of queue on {iface}")
+
+    if delay and delay not in ("0", "0ms"):
+        cmd = ["tc", "qdisc", "add", "dev", iface, "parent", "1:1",
+               "handle", "10:", "netem", "delay", delay]
+        if os.geteuid() != 0:
+            cmd = ["sudo"] + cmd
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"[WARN] netem unavailable, running without added delay: "
+                  f"{result.stderr.strip()}")
+        else:
+            # Loopback traffic crosses the qdisc in both directions.
+            print(f"[SHAPE] {delay} delay each way on {iface}")
+    return True
+
+
+def clear_bottleneck(iface):
+    cmd = ["tc", "qdisc", "del", "dev", iface, "root"]
+    if os.geteuid() != 0:
+        cmd = ["sudo"] + cmd
+    subprocess.run(cmd, capture_output=True, check=False)
+
+
+def start_delay_probe(interval=PROBE_INTERVAL):
+    """
+    Echo small UDP datagrams across the loopback bottleneck.
+
+    Returns:
+        (samples, stop): samples is a list of (time, rtt_ms) filled in by a
+        background thread until stop is set
+    """
+    echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    echo.bind((SERVER_IP, 0))
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind((SERVER_IP, 0))
+    probe.settimeout(1.0)
+    samples = []
+    stop = threading.Event()
+
+    def echo_loop():
+        echo.settimeout(0.5)
+        while not stop.is_set():
+            try:
+                data, addr = echo.recvfrom(64)
+                echo.sendto(data, addr)
+            except socket.timeout:
+                continue
+
+    def probe_loop():
+        seq = 0
+        while not stop.is_set():
+            sent = time.monotonic()
+            probe.sendto(seq.to_bytes(4, "big"), echo.getsockname())
+            try:
+                while True:
+                    data, _ = probe.recvfrom(64)
+                    if int.from_bytes(data, "big") == seq:
+                        break
+                samples.append((sent, (time.monotonic() - sent) * 1000))
+            except socket.timeout:
+                pass
+            seq += 1
+            time.sleep(interval)
+        echo.close()
+        probe.close()
+
+    threading.Thread(target=echo_loop, daemon=True).start()
+    threading.Thread(target=probe_loop, daemon=True).start()
+    return samples, stop
+
+
+def jain_index(rates):
+    """Jain's fairness index: 1 when all rates are equal, 1/n at worst."""
+    total = sum(rates)
+    if not rates or total == 0:
+        return 0.0
+    return total * total / (len(rates) * sum(r * r for r in rates))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def delivered_at(series, t):
+    """Bytes a flow had delivered at time t, from its progress samples."""
+    delivered = 0
+    for when, count in series:
+        if when > t:
+            break
+        delivered = count
+    return delivered
+
+
+def window_rates(flows, start, end):
+    """Per-flow goodput in bits/s over [start, end]."""
+    return [(delivered_at(f["series"], end) - delivered_at(f["series"], start))
+            * 8 / (end - start) for f in flows]
+
+
+def convergence_time(flows, overlap_start, overlap_end,
+                     window=FAIRNESS_WINDOW, threshold=CONVERGED_JAIN):
+    """
+    Time after the last flow joined until every later window of traffic
+    keeps a Jain index of at least `threshold`.
+
+    Returns:
+        The convergence time in seconds, or None if the flows never settled
+    """
+    converged = None
+    t = overlap_start
+    while t + window <= overlap_end:
+        if jain_index(window_rates(flows, t, t + window)) >= threshold:
+            if converged is None:
+                converged = t
+        else:
+            converged = None
+        t += SAMPLE_INTERVAL
+    if converged is None:
+        return None
+    return converged - overlap_start
+
+
+def run_fairness(flows, size, stagger, timeout=FLOW_TIMEOUT):
+    """Run every flow once over the current bottleneck and sample them."""
+    work_dir = Path(tempfile.mkdtemp(prefix="foggy_fairness_"))
+    test_file = work_dir / "test.in"
+    with open(test_file, "wb") as f:
+        f.truncate(size)
+
+    for i, flow in enumerate(flows):
+        flow["port"] = BASE_PORT + i
+        flow["out"] = work_dir / f"flow{i}.out"
+        flow["log"] = work_dir / f"flow{i}.log"
+        flow["series"] = []
+        env = dict(os.environ, **flow["env"])
+        with open(flow["log"], "w") as log:
+            flow["server_proc"] = subprocess.Popen(
+                [flow["server"], SERVER_IP, str(flow["port"]), str(flow["out"])],
+                stdout=log, stderr=subprocess.STDOUT, env=env)
+    time.sleep(0.5)
+
+    probes, stop_probe = start_delay_probe()
+    # An idle second gives the base RTT the queueing delay is measured from.
+    time.sleep(1.0)
+    t0 = time.monotonic()
+
+    next_start = t0
+    started = 0
+    while True:
+        now = time.monotonic()
+        if started < len(flows) and now >= next_start:
+            flow = flows[started]
+            env = dict(os.environ, **flow["env"])
+            flow["start"] = now
+            flow["client_proc"] = subprocess.Popen(
+                [flow["client"], SERVER_IP, str(flow["port"]), str(test_file)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+            print(f"[FLOW] Started {flow['label']} at {now - t0:.1f}s")
+            started += 1
+            next_start = now + stagger
+
+        for flow in flows[:started]:
+            if flow.get("finish") is None and flow["out"].exists():
+                flow["series"].append((now, flow["out"].stat().st_size))
+            if flow.get("finish") is None and flow["server_proc"].poll() is not None:
+                flow["finish"] = now
+                flow["series"].append((now, flow["out"].stat().st_size
+                                       if flow["out"].exists() else 0))
+                print(f"[FLOW] Finished {flow['label']} at {now - t0:.1f}s")
+
+        if started == len(flows) and all(f.get("finish") for f in flows):
+            break
+        if now - t0 > timeout:
+            print(f"[WARN] Flows did not finish within {timeout}s")
+            break
+        time.sleep(SAMPLE_INTERVAL)
+
+    stop_probe.set()
+    for flow in flows:
+        for proc in (flow.get("client_proc"), flow["server_proc"]):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        flow["bytes"] = flow["series"][-1][1] if flow["series"] else 0
+        flow["complete"] = flow["bytes"] >= size
+        flow["server_output"] = flow["log"].read_text(errors="replace")
+
+    base = [rtt for t, rtt in probes if t < t0]
+    loaded = [rtt for t, rtt in probes if t >= t0]
+    base_rtt = min(base) if base else 0.0
+    queueing = [rtt - base_rtt for rtt in loaded]
+    return t0, queueing
+
+
+def summarize(flows, t0, queueing):
+    """Compute the per-flow and aggregate metrics of one run."""
+    for flow in flows:
+        series = [(t, b) for t, b in flow["series"] if b > 0]
+        finish = flow.get("finish") or time.monotonic()
+        duration = finish - flow["start"]
+        flow["goodput_mbps"] = flow["bytes"] * 8 / duration / 1e6 if duration > 0 else 0.0
+        flow["first_byte"] = series[0][0] if series else finish
+
+    # Fairness is only meaningful while every flow competes.
+    overlap_start = max(f["first_byte"] for f in flows)
+    overlap_end = min(f.get("finish") or time.monotonic() for f in flows)
+    summary = {
+        "overlap_s": max(0.0, overlap_end - overlap_start),
+        "jain": None,
+        "convergence_s": None,
+        "queue_p50_ms": percentile(queueing, 50),
+        "queue_p95_ms": percentile(queueing, 95),
+        "queue_max_ms": max(queueing) if queueing else 0.0,
+    }
+    if overlap_end - overlap_start > SAMPLE_INTERVAL:
+        rates = window_rates(flows, overlap_start, overlap_end)
+        for flow, rate in zip(flows, rates):
+            flow["shared_mbps"] = rate / 1e6
+        summary["jain"] = jain_index(rates)
+        summary["convergence_s"] = convergence_time(flows, overlap_start,
+                                                    overlap_end)
+    summary["overlap_from_s"] = overlap_start - t0
+    return summary
+
+
+def print_report(flows, summary):
+    print("\n" + "=" * 50)
+    print("FAIRNESS RESULTS")
+    print("=" * 50)
+    for flow in flows:
+        shared = flow.get("shared_mbps")
+        shared_text = f", {shared:.2f} Mbps while sharing" if shared is not None else ""
+        status = "" if flow["complete"] else " (INCOMPLETE)"
+        print(f"[FLOW] {flow['label']}: {flow['goodput_mbps']:.2f} Mbps goodput"
+              f"{shared_text}{status}")
+    if summary["jain"] is None:
+        print("[WARN] Flows never overlapped, no fairness index")
+    else:
+        print(f"[FAIR] Jain index {summary['jain']:.3f} over "
+              f"{summary['overlap_s']:.1f}s of competition")
+        if summary["convergence_s"] is None:
+            print(f"[FAIR] Never converged to Jain >= {CONVERGED_JAIN}")
+        else:
+            print(f"[FAIR] Converged {summary['convergence_s']:.1f}s after the "
+                  f"last flow joined")
+    print(f"[QUEUE] Queueing delay p50 {summary['queue_p50_ms']:.1f}ms, "
+          f"p95 {summary['queue_p95_ms']:.1f}ms, max {summary['queue_max_ms']:.1f}ms")
+
+
+def write_results(flows, summary, t0, shaping):
+    """Write per-flow results and the progress time series as CSV."""
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+
+    flows_path = Path(output_dir) / f"fairness_{stamp}_flows.csv"
+    with open(flows_path, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["flow", "bytes", "complete", "goodput_mbps",
+                         "shared_mbps", "start_s", "finish_s", "jain",
+                         "convergence_s", "queue_p50_ms", "queue_p95_ms",
+                         "rate", "delay"])
+        for flow in flows:
+            writer.writerow([
+                flow["label"], flow["bytes"], int(flow["complete"]),
+                f"{flow['goodput_mbps']:.3f}",
+                f"{flow['shared_mbps']:.3f}" if "shared_mbps" in flow else "",
+                f"{flow['start'] - t0:.2f}",
+                f"{flow['finish'] - t0:.2f}" if flow.get("finish") else "",
+                f"{summary['jain']:.4f}" if summary["jain"] is not None else "",
+                f"{summary['convergence_s']:.2f}"
+                if summary["convergence_s"] is not None else "",
+                f"{summary['queue_p50_ms']:.2f}", f"{summary['queue_p95_ms']:.2f}",
+                shaping["rate"], shaping["delay"],
+            ])
+
+    series_path = Path(output_dir) / f"fairness_{stamp}_timeseries.csv"
+    with open(series_path, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["flow", "time_s", "bytes"])
+        for flow in flows:
+            for t, count in flow["series"]:
+                writer.writerow([flow["label"], f"{t - t0:.2f}", count])
+
+    print(f"[CSV] Wrote {flows_path}")
+    print(f"[CSV] Wrote {series_path}")
+
+
+def main():
+    if not sys.platform.startswith("linux"):
+        print("[ERROR] Linux only")
+        sys.exit(1)
+
+    parser = argparse.ArgumentParser(description="Run competing flows over one bottleneck")
+    parser.add_argument("--flow", action="append", default=[],
+                        help="BIN_DIR[:CCA] or 'system'; repeat for each flow")
+    parser.add_argument("--flows", type=int, default=0,
+                        help="add this many bin/ flows using --cca")
+    parser.add_argument("--cca", default="",
+                        help="congestion control for --flows, e.g. reno")
+    parser.add_argument("--rate", default="10mbit", help="bottleneck rate (tc syntax)")
+    parser.add_argument("--delay", default="10ms", help="one-way delay (tc syntax)")
+    parser.add_argument("--queue-ms", type=int, default=100,
+                        help="bottleneck queue, in milliseconds at --rate")
+    parser.add_argument("--iface", default="lo", help="interface to shape")
+    parser.add_argument("--no-shape", action="store_true",
+                        help="use an existing bottleneck instead of installing one")
+    parser.add_argument("--size", default="10MB", help="bytes each flow sends")
+    parser.add_argument("--stagger", type=float, default=2.0,
+                        help="seconds between flow starts")
+    args = parser.parse_args()
+
+    specs = args.flow + [f"bin:{args.cca}" if args.cca else "bin"] * args.flows
+    if len(specs) < 2:
+        specs = specs + ["bin"] * (2 - len(specs))
+    flows = [parse_flow(spec, i) for i, spec in enumerate(specs)]
+    for flow in flows:
+        for binary in (flow["client"], flow["server"]):
+            if not Path(binary).exists():
+                print(f"[ERROR] Binary not found: {binary}")
+                if flow["label"].endswith(":system"):
+                    print("[INFO] Build it with `make system` and copy the "
+                          "client and server to bin/client-system and bin/server-system")
+                sys.exit(1)
+
+    if not args.no_shape and not apply_bottleneck(args.iface, args.rate,
+                                                  args.delay, args.queue_ms):
+        sys.exit(1)
+    try:
+        t0, queueing = run_fairness(flows, parse_size(args.size), args.stagger)
+    finally:
+        if not args.no_shape:
+            print(f"[CLEANUP] Clearing bottleneck...")
+            clear_bottleneck(args.iface)
+
+    summary = summarize(flows, t0, queueing)
+    print_report(flows, summary)
+    write_results(flows, summary, t0, {"rate": args.rate, "delay": args.delay})
+
+
+if __name__ == "__main__":
+    main()
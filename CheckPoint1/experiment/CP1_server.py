@@ -26,6 +26,9 @@ current_dir = Path(__file__).parent
 BINARY = str(current_dir / "bin" / "server")  # Path to server binary on server VM
 CLIENT_BINARY = str(current_dir / "bin" / "client")
 OUTPUT_DIR = str(current_dir / "results") + "/"
+# The server exits on its own once the client's FIN arrives. This only bounds
+# a transfer that stalls or a client that never connects.
+LISTENER_TIMEOUT = 120  # seconds
 
 def hash_the_bin(binary_path=BINARY):
     """
@@ -62,12 +65,16 @@ def hash_the_bin(binary_path=BINARY):
         return error_msg
     
     
-def listener(Output_Dir=OUTPUT_DIR, Binary=BINARY, Server_IP=SERVER_IP, Server_Port=SERVER_PORT):
+def listener(Output_Dir=OUTPUT_DIR, Binary=BINARY, Server_IP=SERVER_IP, Server_Port=SERVER_PORT,
+             Timeout=LISTENER_TIMEOUT):
     print("Listener started")
     try:
         cmd = [Binary, Server_IP, str(Server_Port), Output_Dir + "test.out"]
-        result = subprocess.run(cmd, shell=False, capture_output=True, text=True)
+        result = subprocess.run(cmd, shell=False, capture_output=True, text=True, timeout=Timeout)
         return result.stdout.strip()
+    except subprocess.TimeoutExpired:
+        print(f"[WARN] Server did not finish within {Timeout}s")
+        return "Receive Timeout"
     except Exception as e:
         print(f"Error occurred: {e}")
         return "Receive Error"
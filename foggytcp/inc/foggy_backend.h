@@ -41,4 +41,12 @@ int has_been_acked(foggy_socket_t *sock, uint32_t seq);
  */
 void check_for_pkt(foggy_socket_t *sock, foggy_read_mode_t flags);
 
+/**
+ * Wakes the transmit thread if it is idle. Does nothing unless the socket
+ * runs split receive and transmit threads.
+ *
+ * @param sock The socket.
+ */
+void backend_kick(foggy_socket_t *sock);
+
 #endif  // BACKEND_H_
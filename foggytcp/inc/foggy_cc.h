@@ -0,0 +1,102 @@
+/* Copyright (C) 2024 Hong Kong University of Science and Technology
+
+This repository is used for the Computer Networks (ELEC 3120)
+course taught at Hong Kong University of Science and Technology.
+
+No part of the project may be copied and/or distributed without
+the express permission of the course staff. Everyone is prohibited
+from releasing their forks in any public places. */
+
+/* This file defines the pluggable congestion control interface. Every socket
+holds a pointer to one `foggy_cc_ops_t` that is chosen when the socket is
+created. The backend only ever talks to the window through these hooks, so a
+new algorithm can be added without touching foggy_function.cc. */
+
+#ifndef FOGGY_CC_H_
+#define FOGGY_CC_H_
+
+#include <stdint.h>
+
+#include "foggy_tcp.h"
+
+/**
+ * Information handed to `on_ack` for every ACK that reaches the sender.
+ */
+typedef struct {
+  uint32_t acked;          // Bytes newly acknowledged (0 for a duplicate ACK).
+  int is_dup;              // 1 if this is a duplicate ACK.
+  int in_recovery;         // 1 if the sender is still in loss recovery.
+  int64_t rtt_us;          // RTT sample in microseconds, -1 if unavailable.
+  uint64_t delivery_rate;  // Delivery rate in bytes/s, 0 if unavailable.
+  uint32_t in_flight;      // Bytes in flight after processing the ACK.
+} foggy_ack_sample_t;
+
+typedef struct foggy_cc_ops {
+  const char* name;
+
+  /* Allocates private state in `sock->cc_data` and sets the initial window. */
+  void (*init)(foggy_socket_t* sock);
+  /* Frees whatever `init` allocated. */
+  void (*release)(foggy_socket_t* sock);
+
+  /* Called for every new or duplicate ACK. */
+  void (*on_ack)(foggy_socket_t* sock, const foggy_ack_sample_t* rs);
+  /* Called once when fast retransmit enters loss recovery. */
+  void (*on_loss)(foggy_socket_t* sock);
+  /* Called when the retransmission timer expires. */
+  void (*on_timeout)(foggy_socket_t* sock);
+
+  /* Pacing rate in bytes/s, or 0 to let the window alone clock packets out.
+   * May be NULL. */
+  uint64_t (*pacing_rate)(foggy_socket_t* sock);
+
+  /* Writes up to `max_len` bytes of algorithm-specific data to be carried in
+   * the extension of outgoing ACKs and returns the number of bytes written.
+   * May be NULL. */
+  uint16_t (*encode_ext)(foggy_socket_t* sock, uint8_t* buf, uint16_t max_len);
+  /* Consumes the algorithm-specific extension data of an incoming packet.
+   * May be NULL. */
+  void (*decode_ext)(foggy_socket_t* sock, const uint8_t* buf, uint16_t len);
+} foggy_cc_ops_t;
+
+extern const foggy_cc_ops_t foggy_cc_reno;
+extern const foggy_cc_ops_t foggy_cc_cubic;
+extern const foggy_cc_ops_t foggy_cc_bbr;
+
+/**
+ * Looks up a built-in congestion control by name ("reno", "cubic", "bbr").
+ *
+ * @param name The name of the algorithm. NULL or empty selects the default.
+ *
+ * @return The matching ops table, or NULL if the name is unknown.
+ */
+const foggy_cc_ops_t* foggy_cc_find(const char* name);
+
+/**
+ * Attaches a congestion control to a socket and initializes it.
+ *
+ * @param sock The socket.
+ * @param ops The congestion control to use.
+ */
+void foggy_cc_attach(foggy_socket_t* sock, const foggy_cc_ops_t* ops);
+
+/**
+ * Releases the congestion control state of a socket.
+ *
+ * @param sock The socket.
+ */
+void foggy_cc_detach(foggy_socket_t* sock);
+
+/**
+ * Gets the pacing rate requested by the congestion control of a socket.
+ *
+ * Algorithms that do not provide a rate are paced at cwnd / SRTT, scaled by
+ * 2 in slow start and 1.2 otherwise.
+ *
+ * @param sock The socket.
+ *
+ * @return The pacing rate in bytes/s, or 0 if no estimate is available.
+ */
+uint64_t foggy_cc_pacing_rate(foggy_socket_t* sock);
+
+#endif  // FOGGY_CC_H_
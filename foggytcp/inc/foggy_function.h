@@ -9,6 +9,16 @@ from releasing their forks in any public places. */
 
 #include "foggy_tcp.h"
 
+/* Header extension options. The extension is a sequence of
+ * [kind (1 byte) | length (1 byte) | data (length bytes)] entries. */
+#define EXT_OPT_CC 1    // Opaque data owned by the congestion control.
+#define EXT_OPT_SACK 2  // Up to MAX_SACK_BLOCKS [left, right) pairs.
+#define EXT_OPT_WSCALE 3  // Shift to apply to the advertised window.
+
+#define MAX_SACK_BLOCKS 4
+
+#define MAX_EXTENSION_LEN 128
+
 /**
  * Updates the socket information to represent the newly received packet.
  *
@@ -40,4 +50,86 @@ void process_receive_window(foggy_socket_t *sock);
 
 void transmit_send_window(foggy_socket_t *sock);
 
-void receive_send_window(foggy_socket_t *sock);
\ No newline at end of file
+/**
+ * Drives the initiator side of the handshake: sends the SYN, carrying the
+ * first segment of queued data when possible, and retransmits it until the
+ * SYN-ACK arrives.
+ *
+ * @param sock The socket, in the SYN_SENT state.
+ * @param death Whether the application closed the socket.
+ */
+void check_handshake(foggy_socket_t *sock, int death);
+
+/**
+ * Drives the teardown after the application closed the socket and all data
+ * was acknowledged: sends the FIN, retransmits it, and waits a bounded time
+ * for its ACK and for the peer's FIN.
+ *
+ * @param sock The closing socket.
+ *
+ * @return 1 once the backend may exit.
+ */
+int check_close(foggy_socket_t *sock);
+
+/**
+ * Gets how long the pacer holds back the next segment.
+ *
+ * @param sock The socket.
+ *
+ * @return Nanoseconds until the next segment may be sent, 0 if it may be sent
+ * now or pacing is off.
+ */
+int64_t pacing_delay_ns(foggy_socket_t *sock);
+
+/**
+ * Turns on SO_TXTIME for a socket so paced departure times are enforced by
+ * the kernel (fq or etf qdisc) instead of the backend loop.
+ *
+ * @param sock The socket.
+ *
+ * @return 1 on success, 0 if the kernel does not support it.
+ */
+int enable_txtime(foggy_socket_t *sock);
+
+/**
+ * Processes the acknowledgement carried by a packet: updates the RTT estimate,
+ * releases acknowledged slots, detects duplicate ACKs and feeds the
+ * congestion control.
+ *
+ * @param sock The socket that received the packet.
+ * @param pkt The packet with the ACK flag set.
+ */
+void process_ack(foggy_socket_t *sock, uint8_t *pkt);
+
+/**
+ * Fires the retransmission timer if it expired.
+ *
+ * @param sock The socket to check.
+ */
+void check_retransmit_timeout(foggy_socket_t *sock);
+
+/**
+ * Sends a pure ACK for the data received so far.
+ *
+ * @param sock The socket to acknowledge on.
+ */
+void send_ack(foggy_socket_t *sock);
+
+/**
+ * Sends the delayed ACK if its timer expired.
+ *
+ * @param sock The socket to check.
+ */
+void check_delayed_ack(foggy_socket_t *sock);
+
+/**
+ * Allocates a packet whose header is followed by `ext_len` bytes of extension
+ * data. `create_packet` only reserves room for the fixed header.
+ *
+ * @return A pointer to the newly allocated packet. User must `free` after use.
+ */
+uint8_t *create_packet_with_ext(uint16_t src, uint16_t dst, uint32_t seq,
+                                uint32_t ack, uint8_t flags,
+                                uint16_t adv_window, uint16_t ext_len,
+                                uint8_t *ext_data, uint8_t *payload,
+                                uint16_t payload_len);
\ No newline at end of file
@@ -0,0 +1,102 @@
+/* Copyright (C) 2024 Hong Kong University of Science and Technology
+
+This repository is used for the Computer Networks (ELEC 3120)
+course taught at Hong Kong University of Science and Technology.
+
+No part of the project may be copied and/or distributed without
+the express permission of the course staff. Everyone is prohibited
+from releasing their forks in any public places. */
+
+/* This file defines the byte queues that carry data between the application
+thread and the backend. Each queue has exactly one producer and one consumer,
+so it needs no lock: the producer only moves `tail`, the consumer only moves
+`head`, and each publishes its index with release semantics after touching the
+data.
+
+A side that finds its queue empty (or full) and wants to sleep sets `waiting`
+and blocks on `cond`. The other side only takes `lock` to signal it when
+`waiting` is set, so the common path never touches a mutex. */
+
+#ifndef FOGGY_RING_H_
+#define FOGGY_RING_H_
+
+#include <pthread.h>
+#include <stdint.h>
+#include <atomic>
+
+typedef struct {
+  uint8_t* buf;
+  uint32_t size;
+  std::atomic<uint64_t> head;  // total bytes consumed
+  std::atomic<uint64_t> tail;  // total bytes produced
+
+  std::atomic<int> waiting;  // a side is, or is about to be, asleep on cond
+  pthread_mutex_t lock;
+  pthread_cond_t cond;
+} foggy_ring_t;
+
+/**
+ * Allocates the buffer of a ring and resets it.
+ *
+ * @param ring The ring.
+ * @param size Capacity in bytes.
+ */
+void ring_init(foggy_ring_t* ring, uint32_t size);
+
+/**
+ * Frees the buffer of a ring.
+ *
+ * @param ring The ring.
+ */
+void ring_free(foggy_ring_t* ring);
+
+/**
+ * Gets the number of bytes queued. Either side may call it.
+ *
+ * @param ring The ring.
+ *
+ * @return The number of bytes produced but not yet consumed.
+ */
+uint32_t ring_used(foggy_ring_t* ring);
+
+/**
+ * Appends up to `len` bytes. Only the producer may call it.
+ *
+ * @param ring The ring.
+ * @param data The bytes to append.
+ * @param len The number of bytes to append.
+ *
+ * @return The number of bytes appended, limited by the free space.
+ */
+uint32_t ring_write(foggy_ring_t* ring, const uint8_t* data, uint32_t len);
+
+/**
+ * Removes up to `len` bytes from the front. Only the consumer may call it.
+ *
+ * @param ring The ring.
+ * @param data Where to copy the bytes.
+ * @param len The maximum number of bytes to remove.
+ *
+ * @return The number of bytes removed.
+ */
+uint32_t ring_read(foggy_ring_t* ring, uint8_t* data, uint32_t len);
+
+/**
+ * Blocks until `ready` returns non-zero. The check is repeated after
+ * announcing the sleep, so a wakeup from `ring_wake` is never lost.
+ *
+ * @param ring The ring.
+ * @param ready Condition to wait for.
+ * @param arg Argument passed to `ready`.
+ */
+void ring_wait(foggy_ring_t* ring, int (*ready)(void*), void* arg);
+
+/**
+ * Wakes the other side if it is asleep in `ring_wait`. Call it after
+ * changing the ring or any state `ready` depends on.
+ *
+ * @param ring The ring.
+ */
+void ring_wake(foggy_ring_t* ring);
+
+#endif  // FOGGY_RING_H_
@@ -19,9 +19,13 @@ from releasing their forks in any public places. */
 #include <sys/socket.h>
 #include <sys/types.h>
 #include <time.h>
+#include <atomic>
 #include <deque>
+#include <map>
+#include <unordered_map>
 
 #include "foggy_packet.h"
+#include "foggy_ring.h"
 #include "grading.h"
 
 using namespace std;
@@ -31,7 +35,32 @@ using namespace std;
 #define EXIT_FAILURE 1
 
 /* <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<< */
-#define RECEIVE_WINDOW_SLOT_SIZE 64
+// The receive buffer starts at MAX_NETWORK_BUFFER and is grown up to this
+// limit as the measured sender rate and RTT require.
+#define DEFAULT_MAX_RECEIVE_BUFFER (4 * 1024 * 1024)
+
+// Default cap on bytes buffered for sending, queued and unacknowledged.
+#define DEFAULT_SEND_BUFFER (1024 * 1024)
+// Longest time a sub-MSS tail is held back waiting for more data.
+#define NAGLE_HOLD_US 40000
+// Longest time the transmit thread sleeps before re-checking its timers.
+#define TX_IDLE_US 1000
+
+// How long a closing socket waits for its FIN to be acknowledged and for the
+// peer's FIN, by default.
+#define DEFAULT_LINGER_MS 1000
+
+// How long an initiator waits for the application's first write so the data
+// can ride on the SYN.
+#define SYN_DATA_WAIT_US 10000
+
+typedef enum {
+  CLOSED = 0,
+  LISTEN = 1,
+  SYN_SENT = 2,
+  SYN_RCVD = 3,
+  ESTABLISHED = 4,
+} foggy_tcp_state_t;
 
 typedef enum {
   RENO_SLOW_START = 0,
@@ -44,14 +73,27 @@ typedef struct {
   uint8_t* msg;
 
   int is_rtt_sample;
+  int is_retransmitted;
+  int is_sacked;
   struct timespec send_time;
   time_t timeout_interval;
+
+  // Delivery-rate sampling state captured when the slot was (re)sent.
+  uint64_t delivered;
+  struct timespec delivered_time;
+  struct timespec first_sent_time;
 } send_window_slot_t;
 
-typedef struct {
-  uint8_t* msg;
-  int is_used;
-} receive_window_slot_t;
+/**
+ * Orders sequence numbers with wrap-around, so the receive window can be
+ * keyed by them.
+ */
+struct seq_before {
+  bool operator()(uint32_t a, uint32_t b) const { return (int32_t)(a - b) < 0; }
+};
+
+// Out-of-order segments, keyed by sequence number.
+typedef map<uint32_t, uint8_t*, seq_before> receive_window_t;
 
 /* >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> */
 
@@ -72,34 +114,111 @@ typedef struct {
   uint32_t congestion_window;
 
   reno_state_t reno_state;
-  pthread_mutex_t ack_lock;
+
+  uint32_t bytes_in_flight;
+  int in_recovery;
+  uint32_t recover;  // last_byte_sent when loss recovery was entered
+  int sack_ok;       // the peer reports out-of-order data with SACK blocks
+  uint32_t last_ooo_seq;
+
+  uint32_t ack_pending;  // in-order segments received but not yet ACKed
+  struct timespec ack_deadline;
+
+  uint8_t snd_wscale;  // shift applied to the peer's advertised window
+  uint8_t rcv_wscale;  // shift applied to the window we advertise
+
+  // Receive buffer autotuning (dynamic right-sizing).
+  uint32_t recv_buf_size;
+  uint32_t max_recv_buf_size;
+  int64_t rcv_rtt_us;            // receiver-side RTT estimate, 0 if unknown
+  uint32_t rcv_rtt_seq;          // seq whose arrival completes the sample
+  struct timespec rcv_rtt_time;  // when the sample started, tv_sec 0 if idle
+  uint32_t rcv_space_seq;        // next_seq_expected at the last adjustment
+  struct timespec rcv_space_time;
+
+  int64_t srtt_us;
+  int64_t rttvar_us;
+  int64_t rto_us;
+  struct timespec rto_start;
+
+  uint64_t delivered;  // total bytes acknowledged, cumulatively or by SACK
+  struct timespec delivered_time;
+  struct timespec first_sent_time;  // send time of the last delivered slot
+
+  struct timespec pace_next;  // earliest departure of the next paced segment
 } window_t;
 
+struct foggy_cc_ops;
+
 /**
  * This structure holds the state of a socket. You may modify this structure as
  * you see fit to include any additional state you need for your implementation.
  */
 struct foggy_socket_t {
   int socket;
-  // foggy_tcp_state_t state;
+  foggy_tcp_state_t state;
   pthread_t thread_id;
   uint16_t my_port;
   struct sockaddr_in conn;
-  uint8_t* received_buf;
-  int received_len;
-  pthread_mutex_t recv_lock;
-  pthread_cond_t wait_cond;
-  uint8_t* sending_buf;
-  int sending_len;
+  foggy_ring_t recv_ring;  // in-order data, backend -> application
+  foggy_ring_t send_ring;  // data to send, application -> backend
+  int send_buf_size;       // cap on queued plus unacknowledged bytes
+  std::atomic<int> unacked_len;  // bytes segmented but not yet acknowledged
+  int nagle;
+  struct timespec nagle_start;  // when the held sub-MSS tail was queued
   foggy_socket_type_t type;
-  pthread_mutex_t send_lock;
-  int dying;
-  pthread_mutex_t death_lock;
+  std::atomic<int> dying;
+
+  // With split_threads the backend runs receive/ACK processing and
+  // transmission in two threads that share the window under window_lock.
+  int split_threads;
+  int rx_cpu;  // CPU to pin each thread to, -1 for no pinning
+  int tx_cpu;
+  pthread_t rx_thread_id;
+  pthread_mutex_t window_lock;
+  std::atomic<int> tx_done;
+  // Lets the receive thread and foggy_write wake a sleeping transmit thread.
+  std::atomic<int> tx_kicked;
+  std::atomic<int> tx_waiting;
+  pthread_mutex_t tx_lock;
+  pthread_cond_t tx_cond;
   window_t window;
+  const struct foggy_cc_ops* cc;
+  void* cc_data;
+  int delayed_ack;
+  int syn_data;  // let the first segment ride on the SYN
+  int syn_sent;
+  int syn_retransmitted;
+  struct timespec syn_time;  // when the last SYN left, or socket creation
+
+  // Teardown. Each side sends a FIN once its data is acknowledged; the FIN
+  // takes one sequence number so its ACK is unambiguous.
+  int linger_ms;
+  int fin_sent;
+  int fin_acked;
+  struct timespec fin_time;  // when the first FIN left
+  int peer_fin_pending;      // a FIN arrived ahead of missing data
+  uint32_t peer_fin_seq;
+  std::atomic<int> peer_closed;  // the peer's FIN was received in order
+  int pacing;  // spread segments at the congestion control's pacing rate
+  int txtime;  // hand departure times to the kernel with SO_TXTIME
+
+  // A listener demultiplexes datagrams by source address into one child
+  // socket per peer. Children share the listener's UDP socket and backend
+  // thread, and are handed out by foggy_accept.
+  struct foggy_socket_t* listener;  // parent of a child, NULL otherwise
+  unordered_map<uint64_t, struct foggy_socket_t*> conns;
+  deque<struct foggy_socket_t*> accept_queue;
+  pthread_mutex_t accept_lock;
+  pthread_cond_t accept_cond;  // new connections and finished children
+  struct foggy_socket_t* implicit_conn;  // used by read/write on a listener
+  int accepted;   // the application owns this child
+  int finished;   // the backend is done with this child
 
   /* <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<< */
   deque<send_window_slot_t> send_window;
-  receive_window_slot_t receive_window[RECEIVE_WINDOW_SLOT_SIZE];
+  receive_window_t receive_window;
+  uint32_t ooo_bytes;  // payload bytes held in receive_window
   /* >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> */
 };
 
@@ -174,4 +293,39 @@ int foggy_write(void* sock, const void* buf, int length);
  * You can declare more functions after this point if you need to.
  */
 
+/**
+ * Waits for a new connection on a listener socket.
+ *
+ * Reading from or writing to the listener itself uses the first connection
+ * accepted this way, so single-connection servers need not call it.
+ * Connections must be closed before their listener.
+ *
+ * @param sock The listener socket.
+ *
+ * @return The socket of the new connection, or NULL if the listener is
+ * closing or is not a listener.
+ */
+void* foggy_accept(void* sock);
+
+/**
+ * Creates the child socket for a new peer of a listener and queues it for
+ * foggy_accept. Called by the backend.
+ *
+ * @param listener The listener socket.
+ * @param peer The address the peer's SYN came from.
+ *
+ * @return The child socket.
+ */
+foggy_socket_t* foggy_new_connection(foggy_socket_t* listener,
+                                     const struct sockaddr_in* peer);
+
+/**
+ * Hands a child whose teardown is complete back to its owner: the child is
+ * freed if it was never accepted, otherwise foggy_close is woken up. Called
+ * by the backend after removing the child from the listener.
+ *
+ * @param sock The child socket.
+ */
+void foggy_finish_connection(foggy_socket_t* sock);
+
 #endif  // FOGGY_TCP_H_
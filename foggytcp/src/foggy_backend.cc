@@ -17,8 +17,12 @@ from releasing their forks in any public places. */
 
 
 
+#include <arpa/inet.h>
 #include <assert.h>
+#include <errno.h>
 #include <poll.h>
+#include <pthread.h>
+#include <sched.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
@@ -32,6 +36,8 @@ from releasing their forks in any public places. */
 #include "foggy_packet.h"
 #include "foggy_tcp.h"
 
+#define MIN(X, Y) (((X) < (Y)) ? (X) : (Y))
+
 /**
  * Tells if a given sequence number has been acknowledged by the socket.
  *
@@ -41,12 +47,20 @@ from releasing their forks in any public places. */
  * @return 1 if the sequence number has been acknowledged, 0 otherwise.
  */
 int has_been_acked(foggy_socket_t *sock, uint32_t seq) {
-  int result;
-  while (pthread_mutex_lock(&(sock->window.ack_lock)) != 0) {
-  }
-  result = after(sock->window.last_ack_received, seq);
-  pthread_mutex_unlock(&(sock->window.ack_lock));
-  return result;
+  // Only the backend touches the window, so no lock is needed.
+  return after(sock->window.last_ack_received, seq);
+}
+
+/**
+ * Gets the key a listener files a peer's connection under.
+ *
+ * @param addr The peer's address.
+ *
+ * @return The IPv4 address and port packed into one integer.
+ */
+static uint64_t peer_key(const struct sockaddr_in *addr) {
+  return ((uint64_t)ntohl(addr->sin_addr.s_addr) << 16) |
+         ntohs(addr->sin_port);
 }
 
 /**
@@ -62,22 +76,21 @@ int has_been_acked(foggy_socket_t *sock, uint32_t seq) {
 void check_for_pkt(foggy_socket_t *sock, foggy_read_mode_t flags) {
   foggy_tcp_header_t hdr;
   uint8_t *pkt;
-  socklen_t conn_len = sizeof(sock->conn);
+  struct sockaddr_in from;
+  socklen_t conn_len = sizeof(from);
   ssize_t len = 0;
   uint32_t plen = 0, buf_size = 0, n = 0;
 
-  while (pthread_mutex_lock(&(sock->recv_lock)) != 0) {
-  }
   switch (flags) {
     case NO_FLAG:
       len = recvfrom(sock->socket, &hdr, sizeof(foggy_tcp_header_t), MSG_PEEK,
-                     (struct sockaddr *)&(sock->conn), &conn_len);
+                     (struct sockaddr *)&from, &conn_len);
       break;
 
     // Fallthrough.
     case NO_WAIT:
       len = recvfrom(sock->socket, &hdr, sizeof(foggy_tcp_header_t),
-                     MSG_DONTWAIT | MSG_PEEK, (struct sockaddr *)&(sock->conn),
+                     MSG_DONTWAIT | MSG_PEEK, (struct sockaddr *)&from,
                      &conn_len);
       break;
 
@@ -89,66 +102,304 @@ void check_for_pkt(foggy_socket_t *sock, foggy_read_mode_t flags) {
     pkt = (uint8_t*) malloc(plen);
     while (buf_size < plen) {
       n = recvfrom(sock->socket, pkt + buf_size, plen - buf_size, 0,
-                   (struct sockaddr *)&(sock->conn), &conn_len);
+                   (struct sockaddr *)&from, &conn_len);
       buf_size = buf_size + n;
     }
-    on_recv_pkt(sock, pkt);
+    if (sock->type == TCP_LISTENER) {
+      // Demultiplex by source address. Only a SYN may open a connection;
+      // anything else from an unknown peer is stale and dropped.
+      uint64_t key = peer_key(&from);
+      auto it = sock->conns.find(key);
+      if (it != sock->conns.end()) {
+        on_recv_pkt(it->second, pkt);
+      } else if (get_flags((foggy_tcp_header_t *)pkt) == SYN_FLAG_MASK &&
+                 !sock->dying) {
+        foggy_socket_t *conn = foggy_new_connection(sock, &from);
+        sock->conns[key] = conn;
+        on_recv_pkt(conn, pkt);
+      }
+    } else {
+      sock->conn = from;
+      on_recv_pkt(sock, pkt);
+    }
     free(pkt);
   }
-  pthread_mutex_unlock(&(sock->recv_lock));
 }
 
-void *begin_backend(void *in) {
-  foggy_socket_t *sock = (foggy_socket_t *)in;
-  int death, buf_len, send_signal;
+/**
+ * Decides how many bytes of the send buffer to segment now.
+ *
+ * Full segments are always taken. With Nagle's algorithm a sub-MSS tail is
+ * held while earlier data is unacknowledged, unless it has waited longer
+ * than NAGLE_HOLD_US or the socket is closing.
+ *
+ * @param sock The socket.
+ * @param death Whether the application closed the socket.
+ *
+ * @return The number of bytes to segment.
+ */
+static int segmentable_len(foggy_socket_t *sock, int death) {
+  int queued = (int)ring_used(&(sock->send_ring));
+  int full = queued - queued % (int)MSS;
+  struct timespec now;
+
+  if (full == queued) {
+    sock->nagle_start.tv_sec = 0;
+    return full;
+  }
+  if (!sock->nagle || death || (full == 0 && sock->send_window.empty())) {
+    sock->nagle_start.tv_sec = 0;
+    return queued;
+  }
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  if (sock->nagle_start.tv_sec == 0) {
+    sock->nagle_start = now;
+  } else if ((now.tv_sec - sock->nagle_start.tv_sec) * 1000000 +
+                 (now.tv_nsec - sock->nagle_start.tv_nsec) / 1000 >=
+             NAGLE_HOLD_US) {
+    sock->nagle_start.tv_sec = 0;
+    return queued;
+  }
+  return full;
+}
+
+/**
+ * Pins the calling thread to a CPU.
+ *
+ * @param cpu The CPU, or -1 to leave the thread unpinned.
+ */
+static void pin_to_cpu(int cpu) {
+  cpu_set_t set;
+  int err;
+
+  if (cpu < 0) return;
+  CPU_ZERO(&set);
+  CPU_SET(cpu, &set);
+  err = pthread_setaffinity_np(pthread_self(), sizeof(set), &set);
+  if (err != 0) {
+    fprintf(stderr, "Cannot pin backend thread to CPU %d: %s\n", cpu,
+            strerror(err));
+  }
+}
+
+/**
+ * Publishes how much of the send buffer is held by unacknowledged data and
+ * wakes a writer blocked on it.
+ *
+ * @param sock The socket.
+ */
+static void release_send_space(foggy_socket_t *sock) {
+  sock->unacked_len =
+      sock->window.last_byte_sent - sock->window.last_ack_received;
+  ring_wake(&(sock->send_ring));
+}
+
+/**
+ * Segments whatever the send buffer allows and (re)transmits from the send
+ * window.
+ *
+ * @param sock The socket.
+ * @param death Whether the application closed the socket.
+ *
+ * @return The number of new bytes segmented.
+ */
+static int transmit_step(foggy_socket_t *sock, int death) {
+  int buf_len;
   uint8_t *data;
 
-  while (1) {
-    while (pthread_mutex_lock(&(sock->death_lock)) != 0) {
-    }
-    death = sock->dying;
-    pthread_mutex_unlock(&(sock->death_lock));
+  if (!sock->send_window.empty()) {
+    send_pkts(sock, NULL, 0);
+  }
+  buf_len = segmentable_len(sock, death);
+  if (buf_len > 0) {
+    data = (uint8_t*)malloc(buf_len);
+    ring_read(&(sock->send_ring), data, buf_len);
+    send_pkts(sock, data, buf_len);
+    free(data);
+  }
+  return buf_len;
+}
 
-    while (pthread_mutex_lock(&(sock->send_lock)) != 0) {
-    }
-    buf_len = sock->sending_len;
+void backend_kick(foggy_socket_t *sock) {
+  if (!sock->split_threads) return;
+  sock->tx_kicked = 1;
+  std::atomic_thread_fence(std::memory_order_seq_cst);
+  if (sock->tx_waiting) {
+    pthread_mutex_lock(&(sock->tx_lock));
+    pthread_cond_signal(&(sock->tx_cond));
+    pthread_mutex_unlock(&(sock->tx_lock));
+  }
+}
 
-    if (!sock->send_window.empty()) {
-      // printf("Sending window is not empty\n");
-      send_pkts(sock, NULL, 0);
-      check_for_pkt(sock, NO_WAIT);
-    }
+/**
+ * Puts the transmit thread to sleep until it is kicked or `ns` elapse.
+ *
+ * @param sock The socket.
+ * @param ns The longest time to sleep, so timers and the pacer are still
+ * serviced.
+ */
+static void tx_sleep(foggy_socket_t *sock, int64_t ns) {
+  struct timespec deadline;
 
-    if (death && buf_len == 0 && sock->send_window.empty()) {
+  clock_gettime(CLOCK_REALTIME, &deadline);
+  deadline.tv_nsec += ns;
+  deadline.tv_sec += deadline.tv_nsec / 1000000000;
+  deadline.tv_nsec %= 1000000000;
+
+  pthread_mutex_lock(&(sock->tx_lock));
+  sock->tx_waiting = 1;
+  std::atomic_thread_fence(std::memory_order_seq_cst);
+  while (!sock->tx_kicked) {
+    if (pthread_cond_timedwait(&(sock->tx_cond), &(sock->tx_lock),
+                               &deadline) == ETIMEDOUT) {
       break;
     }
+  }
+  sock->tx_waiting = 0;
+  sock->tx_kicked = 0;
+  pthread_mutex_unlock(&(sock->tx_lock));
+}
 
-    if (buf_len > 0) {
-      
-      data = (uint8_t*)malloc(buf_len);
-      memcpy(data, sock->sending_buf, buf_len);
-      sock->sending_len = 0;
-      free(sock->sending_buf);
-      sock->sending_buf = NULL;
-      pthread_mutex_unlock(&(sock->send_lock));
-      send_pkts(sock, data, buf_len);
-      free(data);
+/**
+ * Receive thread of a socket with split threads. It blocks on the UDP socket
+ * and processes every packet under `window_lock`; ACKs that open the window
+ * transmit from here directly, and the transmit thread is kicked for the
+ * rest.
+ */
+static void *begin_rx(void *in) {
+  foggy_socket_t *sock = (foggy_socket_t *)in;
+  struct pollfd pfd;
+
+  pin_to_cpu(sock->rx_cpu);
+  pfd.fd = sock->socket;
+  pfd.events = POLLIN;
+  while (!sock->tx_done) {
+    // Wake up now and then to notice that the transmit thread has finished.
+    if (poll(&pfd, 1, 10) <= 0) continue;
+
+    pthread_mutex_lock(&(sock->window_lock));
+    check_for_pkt(sock, NO_WAIT);
+    release_send_space(sock);
+    pthread_mutex_unlock(&(sock->window_lock));
+    backend_kick(sock);
+  }
+  return NULL;
+}
+
+/**
+ * Transmit side of a socket with split threads: segmentation, transmission,
+ * retransmission timers and delayed ACKs. It sleeps while it has nothing to
+ * send and is kicked by new data or ACKs.
+ */
+static void run_split_backend(foggy_socket_t *sock) {
+  uint32_t last_byte_sent;
+  int death, progress;
+  int64_t pace_ns;
+
+  pthread_create(&(sock->rx_thread_id), NULL, begin_rx, (void *)sock);
+  while (1) {
+    death = sock->dying;
+
+    pthread_mutex_lock(&(sock->window_lock));
+    if (death && ring_used(&(sock->send_ring)) == 0 &&
+        sock->send_window.empty() && check_close(sock)) {
+      pthread_mutex_unlock(&(sock->window_lock));
+      break;
+    }
+    last_byte_sent = sock->window.last_byte_sent;
+    if (sock->state == SYN_SENT) {
+      check_handshake(sock, death);
+      progress = 0;
     } else {
-      pthread_mutex_unlock(&(sock->send_lock));
+      progress = sock->state == ESTABLISHED &&
+                 (transmit_step(sock, death) > 0 ||
+                  last_byte_sent != sock->window.last_byte_sent);
     }
+    check_delayed_ack(sock);
+    release_send_space(sock);
+    pace_ns = pacing_delay_ns(sock);
+    pthread_mutex_unlock(&(sock->window_lock));
+
+    // Sleep until the pacer releases the next segment, or until kicked.
+    if (pace_ns > 0) {
+      tx_sleep(sock, MIN(pace_ns, (int64_t)TX_IDLE_US * 1000));
+    } else if (!progress) {
+      tx_sleep(sock, (int64_t)TX_IDLE_US * 1000);
+    }
+  }
+  sock->tx_done = 1;
+  pthread_join(sock->rx_thread_id, NULL);
+}
+
+/**
+ * Backend of a listener. One thread serves every connection: each packet is
+ * handed to its connection by check_for_pkt, then every connection gets its
+ * turn to transmit. Connections whose teardown is complete are removed and
+ * handed back to their owner. Split threads are not used here, as the
+ * connections share one UDP socket.
+ */
+static void run_listener_backend(foggy_socket_t *sock) {
+  int death, cdeath;
+
+  while (1) {
+    death = sock->dying;
+    if (death && sock->conns.empty()) break;
 
     check_for_pkt(sock, NO_WAIT);
+    for (auto it = sock->conns.begin(); it != sock->conns.end();) {
+      foggy_socket_t *conn = it->second;
+      cdeath = conn->dying || death;
 
-    while (pthread_mutex_lock(&(sock->recv_lock)) != 0) {
+      if (cdeath && ring_used(&(conn->send_ring)) == 0 &&
+          conn->send_window.empty() && check_close(conn)) {
+        it = sock->conns.erase(it);
+        foggy_finish_connection(conn);
+        continue;
+      }
+      if (conn->state == ESTABLISHED) {
+        transmit_step(conn, cdeath);
+      }
+      check_delayed_ack(conn);
+      release_send_space(conn);
+      ++it;
     }
+  }
+}
 
-    send_signal = sock->received_len > 0;
+void *begin_backend(void *in) {
+  foggy_socket_t *sock = (foggy_socket_t *)in;
+  int death;
+
+  pin_to_cpu(sock->tx_cpu);
+  if (sock->type == TCP_LISTENER) {
+    run_listener_backend(sock);
+    pthread_exit(NULL);
+    return NULL;
+  }
+  if (sock->split_threads) {
+    run_split_backend(sock);
+    pthread_exit(NULL);
+    return NULL;
+  }
+
+  while (1) {
+    death = sock->dying;
 
-    pthread_mutex_unlock(&(sock->recv_lock));
+    if (death && ring_used(&(sock->send_ring)) == 0 &&
+        sock->send_window.empty() && check_close(sock)) {
+      break;
+    }
 
-    if (send_signal) {
-      pthread_cond_signal(&(sock->wait_cond));
+    if (sock->state == SYN_SENT) {
+      check_handshake(sock, death);
+    } else if (sock->state == ESTABLISHED) {
+      transmit_step(sock, death);
     }
+    check_for_pkt(sock, NO_WAIT);
+    check_delayed_ack(sock);
+
+    // ACKs free room in the send buffer; wake a writer blocked on it.
+    release_send_space(sock);
   }
 
   pthread_exit(NULL);
@@ -0,0 +1,272 @@
+/* Copyright (C) 2024 Hong Kong University of Science and Technology
+
+This repository is used for the Computer Networks (ELEC 3120)
+course taught at Hong Kong University of Science and Technology.
+
+No part of the project may be copied and/or distributed without
+the express permission of the course staff. Everyone is prohibited
+from releasing their forks in any public places. */
+
+/*
+ * This file implements a BBR-like congestion control. Instead of reacting to
+ * loss it keeps a model of the path: the bottleneck bandwidth (windowed max of
+ * delivery rate samples) and the propagation delay (windowed min of RTT
+ * samples). The window is capped at a multiple of their product and the
+ * pacing rate cycles around the bandwidth estimate to probe for more.
+ *
+ * When both ends run it, ACKs carry the receiver's clock in the header
+ * extension so the sender can measure the arrival rate at the receiver, which
+ * is immune to compression of ACKs on the reverse path.
+ */
+
+#include <arpa/inet.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "foggy_cc.h"
+
+#define MIN(X, Y) (((X) < (Y)) ? (X) : (Y))
+#define MAX(X, Y) (((X) > (Y)) ? (X) : (Y))
+
+#define BBR_BW_ROUNDS 10
+#define BBR_MIN_RTT_WINDOW_US 10000000
+#define BBR_PROBE_RTT_US 200000
+#define BBR_HIGH_GAIN 2.89
+#define BBR_CWND_GAIN 2.0
+#define BBR_MIN_CWND (4 * MSS)
+#define BBR_CYCLE_LEN 8
+
+typedef enum {
+  BBR_STARTUP = 0,
+  BBR_DRAIN = 1,
+  BBR_PROBE_BW = 2,
+  BBR_PROBE_RTT = 3,
+} bbr_mode_t;
+
+static const double bbr_pacing_gains[BBR_CYCLE_LEN] = {1.25, 0.75, 1, 1,
+                                                       1,    1,    1, 1};
+
+typedef struct {
+  bbr_mode_t mode;
+
+  uint64_t bw[BBR_BW_ROUNDS];  // Max delivery rate seen in each recent round.
+  uint32_t round;
+  uint64_t round_end;  // `delivered` value that closes the current round.
+
+  int64_t min_rtt_us;
+  int64_t min_rtt_stamp_us;
+  int64_t probe_rtt_done_us;
+
+  uint64_t full_bw;
+  int full_bw_rounds;
+
+  int cycle_idx;
+  int64_t cycle_stamp_us;
+  double pacing_gain;
+  double cwnd_gain;
+
+  // Receiver-clock arrival rate measurement.
+  uint64_t peer_ts_us;
+  uint64_t rx_start_ts_us;
+  uint64_t rx_bytes;
+  uint64_t rx_rate;
+} bbr_t;
+
+static int64_t now_us() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (int64_t)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+}
+
+static uint64_t bbr_max_bw(bbr_t* bbr) {
+  uint64_t bw = 0;
+  for (int i = 0; i < BBR_BW_ROUNDS; ++i) bw = MAX(bw, bbr->bw[i]);
+  return bw;
+}
+
+static uint32_t bbr_bdp(bbr_t* bbr, double gain) {
+  uint64_t bw = bbr_max_bw(bbr);
+  if (bw == 0 || bbr->min_rtt_us < 0) return 0;
+  return (uint32_t)(gain * bw * bbr->min_rtt_us / 1000000);
+}
+
+static void bbr_init(foggy_socket_t* sock) {
+  bbr_t* bbr = (bbr_t*)calloc(1, sizeof(bbr_t));
+  bbr->mode = BBR_STARTUP;
+  bbr->min_rtt_us = -1;
+  bbr->pacing_gain = BBR_HIGH_GAIN;
+  bbr->cwnd_gain = BBR_HIGH_GAIN;
+  sock->cc_data = bbr;
+  sock->window.congestion_window = WINDOW_INITIAL_WINDOW_SIZE;
+  sock->window.ssthresh = WINDOW_INITIAL_SSTHRESH;
+}
+
+static void bbr_release(foggy_socket_t* sock) { free(sock->cc_data); }
+
+static void bbr_update_bw(foggy_socket_t* sock, bbr_t* bbr,
+                          const foggy_ack_sample_t* rs) {
+  uint64_t sample = rs->delivery_rate;
+  if (sample == 0) return;
+  if (bbr->rx_rate > 0) sample = MIN(sample, bbr->rx_rate);
+
+  if (sock->window.delivered >= bbr->round_end) {
+    bbr->round++;
+    bbr->round_end = sock->window.delivered + rs->in_flight;
+    bbr->bw[bbr->round % BBR_BW_ROUNDS] = 0;
+
+    // Startup ends once the bandwidth stops growing by 25% per round.
+    if (bbr->mode == BBR_STARTUP) {
+      uint64_t bw = bbr_max_bw(bbr);
+      if (bw >= bbr->full_bw * 5 / 4) {
+        bbr->full_bw = bw;
+        bbr->full_bw_rounds = 0;
+      } else if (++bbr->full_bw_rounds >= 3) {
+        bbr->mode = BBR_DRAIN;
+        bbr->pacing_gain = 1 / BBR_HIGH_GAIN;
+        bbr->cwnd_gain = BBR_HIGH_GAIN;
+      }
+    }
+  }
+  uint64_t* slot = &bbr->bw[bbr->round % BBR_BW_ROUNDS];
+  *slot = MAX(*slot, sample);
+}
+
+static void bbr_update_mode(bbr_t* bbr,
+                            const foggy_ack_sample_t* rs) {
+  int64_t now = now_us();
+
+  if (rs->rtt_us > 0 &&
+      (bbr->min_rtt_us < 0 || rs->rtt_us <= bbr->min_rtt_us ||
+       now - bbr->min_rtt_stamp_us > BBR_MIN_RTT_WINDOW_US)) {
+    bbr->min_rtt_us = rs->rtt_us;
+    bbr->min_rtt_stamp_us = now;
+  }
+
+  switch (bbr->mode) {
+    case BBR_DRAIN:
+      if (rs->in_flight <= bbr_bdp(bbr, 1.0)) {
+        bbr->mode = BBR_PROBE_BW;
+        bbr->cwnd_gain = BBR_CWND_GAIN;
+        bbr->cycle_idx = 0;
+        bbr->cycle_stamp_us = now;
+        bbr->pacing_gain = bbr_pacing_gains[0];
+      }
+      break;
+
+    case BBR_PROBE_BW:
+      if (bbr->min_rtt_us > 0 && now - bbr->cycle_stamp_us > bbr->min_rtt_us) {
+        bbr->cycle_idx = (bbr->cycle_idx + 1) % BBR_CYCLE_LEN;
+        bbr->cycle_stamp_us = now;
+        bbr->pacing_gain = bbr_pacing_gains[bbr->cycle_idx];
+      }
+      if (now - bbr->min_rtt_stamp_us > BBR_MIN_RTT_WINDOW_US) {
+        bbr->mode = BBR_PROBE_RTT;
+        bbr->pacing_gain = 1;
+        bbr->probe_rtt_done_us = now + BBR_PROBE_RTT_US;
+      }
+      break;
+
+    case BBR_PROBE_RTT:
+      if (now >= bbr->probe_rtt_done_us) {
+        bbr->min_rtt_stamp_us = now;
+        bbr->mode = BBR_PROBE_BW;
+        bbr->cycle_stamp_us = now;
+      }
+      break;
+
+    default:
+      break;
+  }
+}
+
+static void bbr_on_ack(foggy_socket_t* sock, const foggy_ack_sample_t* rs) {
+  bbr_t* bbr = (bbr_t*)sock->cc_data;
+  window_t* win = &sock->window;
+
+  if (rs->is_dup) return;
+
+  bbr_update_bw(sock, bbr, rs);
+  bbr_update_mode(bbr, rs);
+
+  if (bbr->mode == BBR_PROBE_RTT) {
+    win->congestion_window = BBR_MIN_CWND;
+    return;
+  }
+
+  uint32_t target = bbr_bdp(bbr, bbr->cwnd_gain);
+  if (target == 0) {
+    // No model yet: grow like slow start.
+    win->congestion_window += rs->acked;
+  } else if (bbr->mode == BBR_STARTUP) {
+    win->congestion_window = MAX(win->congestion_window + rs->acked, target);
+  } else {
+    win->congestion_window = MIN(win->congestion_window + rs->acked, target);
+  }
+  win->congestion_window = MAX(win->congestion_window, (uint32_t)BBR_MIN_CWND);
+}
+
+static void bbr_on_loss(foggy_socket_t* sock) {
+  // Packet conservation: keep at most what is still in flight.
+  sock->window.congestion_window =
+      MAX(sock->window.bytes_in_flight, (uint32_t)BBR_MIN_CWND);
+}
+
+static void bbr_on_timeout(foggy_socket_t* sock) {
+  bbr_t* bbr = (bbr_t*)sock->cc_data;
+  sock->window.congestion_window = MSS;
+  bbr->rx_start_ts_us = 0;
+}
+
+static uint64_t bbr_pacing_rate(foggy_socket_t* sock) {
+  bbr_t* bbr = (bbr_t*)sock->cc_data;
+  uint64_t bw = bbr_max_bw(bbr);
+  if (bw == 0) return 0;
+  return (uint64_t)(bbr->pacing_gain * bw);
+}
+
+static uint16_t bbr_encode_ext(foggy_socket_t* sock, uint8_t* buf,
+                               uint16_t max_len) {
+  (void)sock;
+  if (max_len < 8) return 0;
+  uint64_t ts = (uint64_t)now_us();
+  uint32_t hi = htonl((uint32_t)(ts >> 32)), lo = htonl((uint32_t)ts);
+  memcpy(buf, &hi, 4);
+  memcpy(buf + 4, &lo, 4);
+  return 8;
+}
+
+static void bbr_decode_ext(foggy_socket_t* sock, const uint8_t* buf,
+                           uint16_t len) {
+  bbr_t* bbr = (bbr_t*)sock->cc_data;
+  uint32_t hi, lo;
+  if (len < 8) return;
+  memcpy(&hi, buf, 4);
+  memcpy(&lo, buf + 4, 4);
+  uint64_t ts = ((uint64_t)ntohl(hi) << 32) | ntohl(lo);
+
+  // Measure arrival rate at the receiver over at least a quarter RTT.
+  if (bbr->rx_start_ts_us == 0) {
+    bbr->rx_start_ts_us = ts;
+    bbr->rx_bytes = sock->window.delivered;
+  } else if (bbr->min_rtt_us > 0 &&
+             ts - bbr->rx_start_ts_us >= (uint64_t)bbr->min_rtt_us / 4) {
+    bbr->rx_rate = (sock->window.delivered - bbr->rx_bytes) * 1000000 /
+                   (ts - bbr->rx_start_ts_us);
+    bbr->rx_start_ts_us = ts;
+    bbr->rx_bytes = sock->window.delivered;
+  }
+  bbr->peer_ts_us = ts;
+}
+
+const foggy_cc_ops_t foggy_cc_bbr = {
+    "bbr",
+    bbr_init,
+    bbr_release,
+    bbr_on_ack,
+    bbr_on_loss,
+    bbr_on_timeout,
+    bbr_pacing_rate,
+    bbr_encode_ext,
+    bbr_decode_ext,
+};
@@ -0,0 +1,120 @@
+/* Copyright (C) 2024 Hong Kong University of Science and Technology
+
+This repository is used for the Computer Networks (ELEC 3120)
+course taught at Hong Kong University of Science and Technology.
+
+No part of the project may be copied and/or distributed without
+the express permission of the course staff. Everyone is prohibited
+from releasing their forks in any public places. */
+
+/*
+ * This file implements the congestion control registry and TCP Reno.
+ */
+
+#include <stdio.h>
+#include <string.h>
+
+#include "foggy_cc.h"
+
+#define MIN(X, Y) (((X) < (Y)) ? (X) : (Y))
+#define MAX(X, Y) (((X) > (Y)) ? (X) : (Y))
+
+static const foggy_cc_ops_t* builtin_ccs[] = {
+    &foggy_cc_reno,
+    &foggy_cc_cubic,
+    &foggy_cc_bbr,
+};
+
+const foggy_cc_ops_t* foggy_cc_find(const char* name) {
+  if (name == NULL || name[0] == '\0') return &foggy_cc_reno;
+  for (size_t i = 0; i < sizeof(builtin_ccs) / sizeof(builtin_ccs[0]); ++i) {
+    if (strcmp(builtin_ccs[i]->name, name) == 0) return builtin_ccs[i];
+  }
+  return NULL;
+}
+
+void foggy_cc_attach(foggy_socket_t* sock, const foggy_cc_ops_t* ops) {
+  sock->cc = ops;
+  sock->cc_data = NULL;
+  if (ops->init != NULL) ops->init(sock);
+}
+
+void foggy_cc_detach(foggy_socket_t* sock) {
+  if (sock->cc != NULL && sock->cc->release != NULL) sock->cc->release(sock);
+  sock->cc_data = NULL;
+}
+
+uint64_t foggy_cc_pacing_rate(foggy_socket_t* sock) {
+  window_t* win = &sock->window;
+  if (sock->cc->pacing_rate != NULL) return sock->cc->pacing_rate(sock);
+  if (win->srtt_us <= 0) return 0;
+  // As in Linux, pace ahead of cwnd / SRTT so the window can still grow:
+  // twice as fast in slow start, 20% faster in congestion avoidance.
+  uint64_t rate =
+      (uint64_t)win->congestion_window * 1000000 / (uint64_t)win->srtt_us;
+  return win->congestion_window < win->ssthresh ? rate * 2 : rate * 6 / 5;
+}
+
+/* <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<< Reno >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> */
+
+static void reno_init(foggy_socket_t* sock) {
+  sock->window.congestion_window = WINDOW_INITIAL_WINDOW_SIZE;
+  sock->window.ssthresh = WINDOW_INITIAL_SSTHRESH;
+  sock->window.reno_state = RENO_SLOW_START;
+}
+
+static void reno_on_ack(foggy_socket_t* sock, const foggy_ack_sample_t* rs) {
+  window_t* win = &sock->window;
+
+  if (win->reno_state == RENO_FAST_RECOVERY) {
+    if (rs->is_dup && !win->sack_ok) {
+      // Each duplicate ACK means another segment has left the network. With
+      // SACK this is already reflected in bytes_in_flight.
+      win->congestion_window += MSS;
+    } else if (!rs->in_recovery) {
+      // Deflate the window once all data outstanding at the loss is ACKed.
+      win->congestion_window = win->ssthresh;
+      win->reno_state = RENO_CONGESTION_AVOIDANCE;
+    }
+    return;
+  }
+  if (rs->is_dup) return;
+
+  // Appropriate byte counting (RFC 3465) keeps growth independent of how
+  // many segments each ACK covers, e.g. with a delayed-ACK receiver.
+  if (win->reno_state == RENO_SLOW_START) {
+    win->congestion_window += MIN(rs->acked, 2 * (uint32_t)MSS);
+    if (win->congestion_window >= win->ssthresh) {
+      win->reno_state = RENO_CONGESTION_AVOIDANCE;
+    }
+  } else {
+    win->congestion_window +=
+        MAX((uint32_t)((uint64_t)MSS * rs->acked / win->congestion_window), 1u);
+  }
+}
+
+static void reno_on_loss(foggy_socket_t* sock) {
+  window_t* win = &sock->window;
+  win->ssthresh = MAX(win->congestion_window / 2, 2 * (uint32_t)MSS);
+  win->congestion_window = win->ssthresh + (win->sack_ok ? 0 : 3 * MSS);
+  win->reno_state = RENO_FAST_RECOVERY;
+}
+
+static void reno_on_timeout(foggy_socket_t* sock) {
+  window_t* win = &sock->window;
+  win->ssthresh = MAX(win->congestion_window / 2, 2 * (uint32_t)MSS);
+  win->congestion_window = MSS;
+  win->reno_state = RENO_SLOW_START;
+}
+
+const foggy_cc_ops_t foggy_cc_reno = {
+    "reno",
+    reno_init,
+    NULL,
+    reno_on_ack,
+    reno_on_loss,
+    reno_on_timeout,
+    NULL,
+    NULL,
+    NULL,
+};
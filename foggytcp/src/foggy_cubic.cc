@@ -0,0 +1,156 @@
+/* Copyright (C) 2024 Hong Kong University of Science and Technology
+
+This repository is used for the Computer Networks (ELEC 3120)
+course taught at Hong Kong University of Science and Technology.
+
+No part of the project may be copied and/or distributed without
+the express permission of the course staff. Everyone is prohibited
+from releasing their forks in any public places. */
+
+/*
+ * This file implements CUBIC congestion control (RFC 8312). Window growth in
+ * congestion avoidance follows a cubic function of the time since the last
+ * loss instead of the number of ACKs, which makes it RTT-fair and lets it
+ * reclaim bandwidth quickly on long fat paths.
+ */
+
+#include <math.h>
+#include <stdlib.h>
+#include <time.h>
+
+#include "foggy_cc.h"
+
+#define MIN(X, Y) (((X) < (Y)) ? (X) : (Y))
+#define MAX(X, Y) (((X) > (Y)) ? (X) : (Y))
+
+#define CUBIC_C 0.4
+#define CUBIC_BETA 0.7
+
+typedef struct {
+  double w_max;        // Window (in MSS) right before the last reduction.
+  double k;            // Seconds to climb back to w_max.
+  double origin;       // Plateau of the cubic function (in MSS).
+  double w_est;        // Reno-friendly window estimate (in MSS).
+  double epoch_start;  // Start of the current avoidance epoch, 0 if unset.
+  int64_t min_rtt_us;
+} cubic_t;
+
+static double now_sec() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void cubic_init(foggy_socket_t* sock) {
+  cubic_t* ca = (cubic_t*)calloc(1, sizeof(cubic_t));
+  ca->min_rtt_us = -1;
+  sock->cc_data = ca;
+  sock->window.congestion_window = WINDOW_INITIAL_WINDOW_SIZE;
+  sock->window.ssthresh = WINDOW_INITIAL_SSTHRESH;
+  sock->window.reno_state = RENO_SLOW_START;
+}
+
+static void cubic_release(foggy_socket_t* sock) { free(sock->cc_data); }
+
+static void cubic_avoid(foggy_socket_t* sock, cubic_t* ca, uint32_t acked) {
+  window_t* win = &sock->window;
+  double cwnd = (double)win->congestion_window / MSS;
+  double t;
+
+  if (ca->epoch_start == 0) {
+    ca->epoch_start = now_sec();
+    if (cwnd < ca->w_max) {
+      ca->k = cbrt((ca->w_max - cwnd) / CUBIC_C);
+      ca->origin = ca->w_max;
+    } else {
+      ca->k = 0;
+      ca->origin = cwnd;
+    }
+    ca->w_est = cwnd;
+  }
+
+  t = now_sec() - ca->epoch_start;
+  if (ca->min_rtt_us > 0) t += ca->min_rtt_us / 1e6;
+  double target = ca->origin + CUBIC_C * (t - ca->k) * (t - ca->k) * (t - ca->k);
+
+  double segs = (double)acked / MSS;
+  ca->w_est += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * segs / cwnd;
+  if (ca->w_est > target) target = ca->w_est;
+
+  if (target > cwnd) {
+    // Grow by at most 50% per RTT, as in the RFC.
+    double inc = MIN((target - cwnd) / cwnd, 0.5) * segs;
+    win->congestion_window += MAX((uint32_t)(inc * MSS), 1u);
+  } else {
+    win->congestion_window += MAX((uint32_t)(segs * MSS / (100 * cwnd)), 1u);
+  }
+}
+
+static void cubic_on_ack(foggy_socket_t* sock, const foggy_ack_sample_t* rs) {
+  cubic_t* ca = (cubic_t*)sock->cc_data;
+  window_t* win = &sock->window;
+
+  if (rs->rtt_us > 0 && (ca->min_rtt_us < 0 || rs->rtt_us < ca->min_rtt_us)) {
+    ca->min_rtt_us = rs->rtt_us;
+  }
+
+  if (win->reno_state == RENO_FAST_RECOVERY) {
+    if (rs->is_dup && !win->sack_ok) {
+      win->congestion_window += MSS;
+    } else if (!rs->in_recovery) {
+      win->congestion_window = win->ssthresh;
+      win->reno_state = RENO_CONGESTION_AVOIDANCE;
+    }
+    return;
+  }
+  if (rs->is_dup) return;
+
+  if (win->reno_state == RENO_SLOW_START) {
+    win->congestion_window += MIN(rs->acked, 2 * (uint32_t)MSS);
+    if (win->congestion_window >= win->ssthresh) {
+      win->reno_state = RENO_CONGESTION_AVOIDANCE;
+    }
+    return;
+  }
+  cubic_avoid(sock, ca, rs->acked);
+}
+
+static void cubic_reduce(foggy_socket_t* sock, cubic_t* ca) {
+  window_t* win = &sock->window;
+  double cwnd = (double)win->congestion_window / MSS;
+
+  // Fast convergence: release bandwidth sooner if the plateau keeps dropping.
+  if (cwnd < ca->w_max) {
+    ca->w_max = cwnd * (1 + CUBIC_BETA) / 2;
+  } else {
+    ca->w_max = cwnd;
+  }
+  ca->epoch_start = 0;
+  win->ssthresh = MAX((uint32_t)(win->congestion_window * CUBIC_BETA),
+                      2 * (uint32_t)MSS);
+}
+
+static void cubic_on_loss(foggy_socket_t* sock) {
+  cubic_reduce(sock, (cubic_t*)sock->cc_data);
+  sock->window.congestion_window =
+      sock->window.ssthresh + (sock->window.sack_ok ? 0 : 3 * MSS);
+  sock->window.reno_state = RENO_FAST_RECOVERY;
+}
+
+static void cubic_on_timeout(foggy_socket_t* sock) {
+  cubic_reduce(sock, (cubic_t*)sock->cc_data);
+  sock->window.congestion_window = MSS;
+  sock->window.reno_state = RENO_SLOW_START;
+}
+
+const foggy_cc_ops_t foggy_cc_cubic = {
+    "cubic",
+    cubic_init,
+    cubic_release,
+    cubic_on_ack,
+    cubic_on_loss,
+    cubic_on_timeout,
+    NULL,
+    NULL,
+    NULL,
+};
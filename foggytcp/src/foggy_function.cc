@@ -11,14 +11,23 @@ from releasing their forks in any public places. */
 #include <cstdlib>
 #include <cstring>
 #include <cstdio>
+#include <sys/socket.h>
+#include <linux/net_tstamp.h>
 
 #include "foggy_function.h"
 #include "foggy_backend.h"
+#include "foggy_cc.h"
 
 
 #define MIN(X, Y) (((X) < (Y)) ? (X) : (Y))
 #define MAX(X, Y) (((X) > (Y)) ? (X) : (Y))
 
+#define DELAYED_ACK_US 40000
+// How far behind schedule the pacer may catch up in a burst.
+#define PACING_SLACK_NS 1000000
+#define MIN_RTO_US 200000
+#define MAX_RTO_US 60000000
+
 #define DEBUG_PRINT 1
 #define debug_printf(fmt, ...)                            \
   do {                                                    \
@@ -26,11 +35,359 @@ from releasing their forks in any public places. */
   } while (0)
 
 
+static int64_t timespec_diff_us(const struct timespec *end,
+                                const struct timespec *start) {
+  return (int64_t)(end->tv_sec - start->tv_sec) * 1000000 +
+         (end->tv_nsec - start->tv_nsec) / 1000;
+}
+
+/**
+ * Updates SRTT, RTTVAR and RTO with a new RTT sample, following RFC 6298.
+ */
+static void update_rtt(foggy_socket_t *sock, int64_t rtt_us) {
+  window_t *win = &sock->window;
+  if (win->srtt_us == 0) {
+    win->srtt_us = rtt_us;
+    win->rttvar_us = rtt_us / 2;
+  } else {
+    int64_t err = win->srtt_us - rtt_us;
+    if (err < 0) err = -err;
+    win->rttvar_us = (3 * win->rttvar_us + err) / 4;
+    win->srtt_us = (7 * win->srtt_us + rtt_us) / 8;
+  }
+  win->rto_us = MIN(MAX(win->srtt_us + 4 * win->rttvar_us, (int64_t)MIN_RTO_US),
+                    (int64_t)MAX_RTO_US);
+}
+
+/**
+ * Accounts for a sent slot that reached the receiver and takes a delivery
+ * rate sample from it. The sample interval is the longer of the send and ACK
+ * intervals, so neither ACK compression nor a burst of sends inflates it.
+ *
+ * @param sock The socket.
+ * @param slot The slot being acknowledged or sacked for the first time.
+ * @param now The current time.
+ *
+ * @return The delivery rate in bytes/s, 0 if unavailable.
+ */
+static uint64_t deliver_slot(foggy_socket_t *sock, send_window_slot_t &slot,
+                             const struct timespec *now) {
+  window_t *win = &sock->window;
+
+  win->delivered += get_payload_len(slot.msg);
+  win->delivered_time = *now;
+  win->first_sent_time = slot.send_time;
+
+  int64_t interval =
+      MAX(timespec_diff_us(now, &slot.delivered_time),
+          timespec_diff_us(&slot.send_time, &slot.first_sent_time));
+  if (interval <= 0) return 0;
+  return (win->delivered - slot.delivered) * 1000000 / interval;
+}
+
+/**
+ * Marks the slots covered by the SACK blocks of an incoming ACK. Sacked data
+ * has left the network, so it no longer counts as in flight.
+ */
+static void process_sack(foggy_socket_t *sock, const uint8_t *data,
+                         uint8_t len) {
+  window_t *win = &sock->window;
+  struct timespec now;
+
+  win->sack_ok = 1;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+
+  for (int off = 0; off + 8 <= len; off += 8) {
+    uint32_t left, right;
+    memcpy(&left, data + off, 4);
+    memcpy(&right, data + off + 4, 4);
+    left = ntohl(left);
+    right = ntohl(right);
+
+    for (auto &slot : sock->send_window) {
+      uint32_t seq = get_seq((foggy_tcp_header_t *)slot.msg);
+      uint32_t end = seq + get_payload_len(slot.msg);
+      if (!after(right, seq)) break;
+      if (slot.is_sacked || before(seq, left) || after(end, right)) continue;
+      if (slot.is_sent) {
+        win->bytes_in_flight -= get_payload_len(slot.msg);
+        deliver_slot(sock, slot, &now);
+      }
+      slot.is_sacked = 1;
+    }
+  }
+}
+
+/**
+ * Dispatches the options found in the header extension of a packet.
+ */
+static void handle_extension(foggy_socket_t *sock, uint8_t *pkt) {
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)pkt;
+  uint16_t ext_len = get_extension_length(hdr);
+  uint8_t *ext = get_extension_data(hdr);
+  uint16_t i = 0;
+
+  while (i + 2 <= ext_len) {
+    uint8_t kind = ext[i], len = ext[i + 1];
+    if (i + 2 + len > ext_len) break;
+    switch (kind) {
+      case EXT_OPT_SACK:
+        process_sack(sock, ext + i + 2, len);
+        break;
+      case EXT_OPT_CC:
+        if (sock->cc->decode_ext != NULL) {
+          sock->cc->decode_ext(sock, ext + i + 2, len);
+        }
+        break;
+      default:
+        break;
+    }
+    i += 2 + len;
+  }
+}
+
+/**
+ * Writes a SACK option describing the out-of-order segments held in the
+ * receive window. As in RFC 2018, the first block covers the most recently
+ * received segment.
+ *
+ * @return The length of the option, 0 if nothing is buffered out of order.
+ */
+static uint16_t build_sack_option(foggy_socket_t *sock, uint8_t *buf) {
+  uint32_t left[MAX_SACK_BLOCKS], right[MAX_SACK_BLOCKS];
+  uint32_t first_left = 0, first_right = 0, cur_left = 0, cur_right = 0;
+  int blocks = 0, has_first = 0;
+
+  if (sock->receive_window.empty()) return 0;
+
+  // Merge contiguous segments into blocks. Only the block holding the most
+  // recent arrival and the highest few blocks are kept.
+  auto close_block = [&]() {
+    if (between(sock->window.last_ooo_seq, cur_left, cur_right - 1)) {
+      first_left = cur_left;
+      first_right = cur_right;
+      has_first = 1;
+    } else {
+      left[blocks % MAX_SACK_BLOCKS] = cur_left;
+      right[blocks % MAX_SACK_BLOCKS] = cur_right;
+      ++blocks;
+    }
+  };
+  auto it = sock->receive_window.begin();
+  cur_left = it->first;
+  cur_right = it->first + get_payload_len(it->second);
+  for (++it; it != sock->receive_window.end(); ++it) {
+    uint32_t seq = it->first, end = seq + get_payload_len(it->second);
+    if (!after(seq, cur_right)) {
+      if (after(end, cur_right)) cur_right = end;
+      continue;
+    }
+    close_block();
+    cur_left = seq;
+    cur_right = end;
+  }
+  close_block();
+
+  // Most recent block first, then the rest from the highest down.
+  int count = 0;
+  buf[0] = EXT_OPT_SACK;
+  if (has_first) {
+    uint32_t l = htonl(first_left), r = htonl(first_right);
+    memcpy(buf + 2, &l, 4);
+    memcpy(buf + 6, &r, 4);
+    ++count;
+  }
+  for (int k = blocks - 1; k >= 0 && k >= blocks - MAX_SACK_BLOCKS &&
+                           count < MAX_SACK_BLOCKS;
+       --k) {
+    uint32_t l = htonl(left[k % MAX_SACK_BLOCKS]);
+    uint32_t r = htonl(right[k % MAX_SACK_BLOCKS]);
+    memcpy(buf + 2 + count * 8, &l, 4);
+    memcpy(buf + 2 + count * 8 + 4, &r, 4);
+    ++count;
+  }
+  buf[1] = (uint8_t)(count * 8);
+  return 2 + count * 8;
+}
+
+/**
+ * Gets the value for the advertised window field: the free receive buffer,
+ * scaled down by our window scale.
+ */
+static uint16_t advertised_window_field(foggy_socket_t *sock) {
+  uint32_t free_space =
+      MAX(sock->window.recv_buf_size - ring_used(&(sock->recv_ring)), MSS);
+  return (uint16_t)MIN(free_space >> sock->window.rcv_wscale, 65535u);
+}
+
+/**
+ * Finds the window scale option of a SYN or SYN-ACK.
+ *
+ * @return The peer's shift, or -1 if the peer does not scale its window.
+ */
+static int find_wscale(uint8_t *pkt) {
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)pkt;
+  uint16_t ext_len = get_extension_length(hdr);
+  uint8_t *ext = get_extension_data(hdr);
+  uint16_t i = 0;
+
+  while (i + 2 <= ext_len) {
+    uint8_t kind = ext[i], len = ext[i + 1];
+    if (i + 2 + len > ext_len) break;
+    if (kind == EXT_OPT_WSCALE && len >= 1) return MIN(ext[i + 2], 14);
+    i += 2 + len;
+  }
+  return -1;
+}
+
+/**
+ * Writes the options carried by an outgoing ACK into `buf`.
+ *
+ * @return The total length of the extension.
+ */
+static uint16_t build_ack_extension(foggy_socket_t *sock, uint8_t *buf) {
+  uint16_t len = 0;
+  if (sock->state == SYN_RCVD) {
+    buf[0] = EXT_OPT_WSCALE;
+    buf[1] = 1;
+    buf[2] = sock->window.rcv_wscale;
+    len = 3;
+  }
+  len += build_sack_option(sock, buf + len);
+  if (sock->cc->encode_ext != NULL) {
+    uint16_t n = sock->cc->encode_ext(sock, buf + len + 2,
+                                      MIN(MAX_EXTENSION_LEN - len - 2, 255));
+    if (n > 0) {
+      buf[len] = EXT_OPT_CC;
+      buf[len + 1] = (uint8_t)n;
+      len += 2 + n;
+    }
+  }
+  return len;
+}
+
+uint8_t *create_packet_with_ext(uint16_t src, uint16_t dst, uint32_t seq,
+                                uint32_t ack, uint8_t flags,
+                                uint16_t adv_window, uint16_t ext_len,
+                                uint8_t *ext_data, uint8_t *payload,
+                                uint16_t payload_len) {
+  uint16_t hlen = sizeof(foggy_tcp_header_t) + ext_len;
+  uint8_t *packet = (uint8_t *)malloc(hlen + payload_len);
+  if (packet == NULL) {
+    return NULL;
+  }
+  foggy_tcp_header_t *header = (foggy_tcp_header_t *)packet;
+  set_header(header, src, dst, seq, ack, hlen, hlen + payload_len, flags,
+             adv_window, 0, NULL);
+  set_extension_length(header, ext_len);
+  memcpy(get_extension_data(header), ext_data, ext_len);
+  memcpy(get_payload(packet), payload, payload_len);
+  return packet;
+}
+
+/**
+ * Tells whether the receive window holds segments beyond a hole.
+ */
+static int has_out_of_order(foggy_socket_t *sock) {
+  return !sock->receive_window.empty();
+}
+
+/**
+ * Marks a sent slot as lost so that the transmit path sends it again.
+ */
+static void mark_lost(foggy_socket_t *sock, send_window_slot_t &slot) {
+  slot.is_sent = 0;
+  slot.is_retransmitted = 1;
+  slot.is_rtt_sample = 0;
+  sock->window.bytes_in_flight -= get_payload_len(slot.msg);
+}
+
+/**
+ * Runs the handshake state machine for a packet received before the
+ * connection is established, or for a SYN.
+ *
+ * The SYN does not consume sequence space: data starts at the initial
+ * sequence number the SYN carries and may already ride on it. The listener
+ * answers with ACKs flagged SYN-ACK until the initiator's first ACK arrives,
+ * so a lost SYN-ACK is repaired by the initiator's SYN retransmission. Window
+ * scaling is offered in the SYN and only used if the SYN-ACK accepts it; the
+ * window field of a SYN is never scaled.
+ *
+ * @return 1 if the packet should go on to ACK and data processing.
+ */
+static int process_handshake(foggy_socket_t *sock, uint8_t *pkt) {
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)pkt;
+  window_t *win = &sock->window;
+  uint8_t flags = get_flags(hdr);
+  int wscale = find_wscale(pkt);
+  struct timespec now;
+
+  switch (sock->state) {
+    case LISTEN:
+      if (flags != SYN_FLAG_MASK) return 0;
+      debug_printf("Received SYN %u\n", get_seq(hdr));
+      win->next_seq_expected = get_seq(hdr);
+      win->rcv_space_seq = win->next_seq_expected;
+      win->advertised_window = get_advertised_window(hdr);
+      if (wscale >= 0) {
+        win->snd_wscale = wscale;
+      } else {
+        win->rcv_wscale = 0;
+      }
+      sock->state = SYN_RCVD;
+      if (get_payload_len(pkt) == 0) send_ack(sock);
+      return 1;
+
+    case SYN_SENT:
+      if (flags != (SYN_FLAG_MASK | ACK_FLAG_MASK)) return 0;
+      debug_printf("Received SYN-ACK %u\n", get_seq(hdr));
+      clock_gettime(CLOCK_MONOTONIC, &now);
+      win->next_seq_expected = get_seq(hdr);
+      win->rcv_space_seq = win->next_seq_expected;
+      if (wscale >= 0) {
+        win->snd_wscale = wscale;
+      } else {
+        win->rcv_wscale = 0;
+      }
+      if (!sock->syn_retransmitted) {
+        update_rtt(sock, timespec_diff_us(&now, &sock->syn_time));
+      }
+      // Data on the SYN that the listener did not take is sent again.
+      if (!sock->send_window.empty() && sock->send_window.front().is_sent &&
+          !after(get_ack(hdr), win->last_ack_received)) {
+        mark_lost(sock, sock->send_window.front());
+      }
+      sock->state = ESTABLISHED;
+      win->rto_start = now;
+      send_ack(sock);
+      return 1;
+
+    case SYN_RCVD:
+      if (!(flags & SYN_FLAG_MASK)) {
+        if (!(flags & ACK_FLAG_MASK)) return 0;
+        sock->state = ESTABLISHED;
+        return 1;
+      }
+      // The SYN-ACK was lost and the SYN came again.
+      [[fallthrough]];
+
+    case ESTABLISHED:
+      // A duplicate SYN or SYN-ACK. Data on it is acknowledged as a
+      // duplicate segment; otherwise answer with a bare ACK.
+      if (get_payload_len(pkt) > 0) return 1;
+      send_ack(sock);
+      return 0;
+
+    default:
+      return 0;
+  }
+}
+
 /**
  * Updates the socket information to represent the newly received packet.
  *
- * In the current stop-and-wait implementation, this function also sends an
- * acknowledgement for the packet.
+ * ACKs are handed to the sender side and data segments are placed in the
+ * receive window, after which an acknowledgement is sent back.
  *
  * @param sock The socket used for handling packets received.
  * @param pkt The packet data received by the socket.
@@ -40,50 +397,218 @@ void on_recv_pkt(foggy_socket_t *sock, uint8_t *pkt) {
   foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)pkt;
   uint8_t flags = get_flags(hdr);
 
-  switch (flags) {
-    case ACK_FLAG_MASK: {
-      uint32_t ack = get_ack(hdr);
-      printf("Receive ACK %d\n", ack);
+  if ((flags & SYN_FLAG_MASK) || sock->state != ESTABLISHED) {
+    if (!process_handshake(sock, pkt)) return;
+  }
+
+  if (flags & ACK_FLAG_MASK) {
+    uint32_t ack = get_ack(hdr);
+    printf("Receive ACK %d\n", ack);
+    if (sock->fin_sent && ack == sock->window.last_byte_sent + 1) {
+      // Only the FIN was left to acknowledge.
+      sock->fin_acked = 1;
+    } else {
+      process_ack(sock, pkt);
+    }
+  } else {
+    handle_extension(sock, pkt);
+  }
+
+  if (flags & FIN_FLAG_MASK) {
+    debug_printf("Received FIN %u\n", get_seq(hdr));
+    if (!sock->peer_closed) {
+      sock->peer_fin_pending = 1;
+      sock->peer_fin_seq = get_seq(hdr);
+      process_receive_window(sock);
+    }
+    send_ack(sock);
+    return;
+  }
+
+  if (get_payload_len(pkt) > 0) {
+    debug_printf("Received data packet %d %d\n", get_seq(hdr),
+                 get_seq(hdr) + get_payload_len(pkt));
 
-      // if (get_payload_len(pkt) == 0) handle_congestion_window(sock, pkt);
-      sock->window.advertised_window = get_advertised_window(hdr);
+    int in_order = get_seq(hdr) == sock->window.next_seq_expected;
+    int had_hole = has_out_of_order(sock);
 
-      if (after(ack, sock->window.last_ack_received)) {
-        sock->window.last_ack_received = ack;
+    // Add the packet to receive window and process receive window
+    add_receive_window(sock, pkt);
+    process_receive_window(sock);
+
+    // Out-of-order segments, segments that fill a hole, short segments and
+    // data on a SYN are acknowledged at once. Otherwise every second full
+    // segment is.
+    if (!sock->delayed_ack || !in_order || had_hole ||
+        (flags & SYN_FLAG_MASK) ||
+        has_out_of_order(sock) || get_payload_len(pkt) < MSS ||
+        ++sock->window.ack_pending >= 2) {
+      send_ack(sock);
+    } else {
+      clock_gettime(CLOCK_MONOTONIC, &sock->window.ack_deadline);
+      sock->window.ack_deadline.tv_nsec += DELAYED_ACK_US * 1000;
+      if (sock->window.ack_deadline.tv_nsec >= 1000000000) {
+        sock->window.ack_deadline.tv_sec += 1;
+        sock->window.ack_deadline.tv_nsec -= 1000000000;
       }
     }
+  }
+}
+
+void send_ack(foggy_socket_t *sock) {
+  // ACKs are built on the stack: they are sent far too often to malloc.
+  uint8_t ack_pkt[sizeof(foggy_tcp_header_t) + MAX_EXTENSION_LEN];
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)ack_pkt;
+  uint16_t ext_len =
+      build_ack_extension(sock, ack_pkt + sizeof(foggy_tcp_header_t));
+  uint16_t hlen = sizeof(foggy_tcp_header_t) + ext_len;
+
+  debug_printf("Sending ACK packet %d\n", sock->window.next_seq_expected);
+  set_header(hdr, sock->my_port, ntohs(sock->conn.sin_port),
+             sock->window.last_byte_sent, sock->window.next_seq_expected, hlen,
+             hlen,
+             sock->state == SYN_RCVD ? SYN_FLAG_MASK | ACK_FLAG_MASK
+                                     : ACK_FLAG_MASK,
+             advertised_window_field(sock), 0, NULL);
+  set_extension_length(hdr, ext_len);
+  sendto(sock->socket, ack_pkt, hlen, 0, (struct sockaddr *)&(sock->conn),
+         sizeof(sock->conn));
+  sock->window.ack_pending = 0;
+}
+
+void check_delayed_ack(foggy_socket_t *sock) {
+  struct timespec now;
 
-    // Fallthrough.
-    default: {
-      if (get_payload_len(pkt) > 0) {
-        debug_printf("Received data packet %d %d\n", get_seq(hdr),
-                     get_seq(hdr) + get_payload_len(pkt));
-
-        sock->window.advertised_window = get_advertised_window(hdr);
-        // Add the packet to receive window and process receive window
-        add_receive_window(sock, pkt);
-        process_receive_window(sock);
-        // Send ACK
-        debug_printf("Sending ACK packet %d\n", sock->window.next_seq_expected);
-
-        uint8_t *ack_pkt = create_packet(
-            sock->my_port, ntohs(sock->conn.sin_port),
-            sock->window.last_byte_sent, sock->window.next_seq_expected,
-            sizeof(foggy_tcp_header_t), sizeof(foggy_tcp_header_t), ACK_FLAG_MASK,
-            MAX(MAX_NETWORK_BUFFER - (uint32_t)sock->received_len, MSS), 0,
-            NULL, NULL, 0);
-        sendto(sock->socket, ack_pkt, sizeof(foggy_tcp_header_t), 0,
-               (struct sockaddr *)&(sock->conn), sizeof(sock->conn));
-        free(ack_pkt);
+  if (sock->window.ack_pending == 0) return;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  if (timespec_diff_us(&now, &sock->window.ack_deadline) >= 0) {
+    send_ack(sock);
+  }
+}
+
+/**
+ * Gets the number of bytes in the send window that the receiver has sacked.
+ */
+static uint32_t sacked_bytes(foggy_socket_t *sock) {
+  uint32_t bytes = 0;
+  for (auto &slot : sock->send_window) {
+    if (slot.is_sacked) bytes += get_payload_len(slot.msg);
+  }
+  return bytes;
+}
+
+/**
+ * Marks as lost every hole that has at least three segments' worth of
+ * sacked data above it (RFC 6675). Holes that were already retransmitted are
+ * left to the retransmission timer.
+ */
+static void mark_sacked_holes_lost(foggy_socket_t *sock) {
+  uint32_t sacked_above = 0;
+  for (auto it = sock->send_window.rbegin(); it != sock->send_window.rend();
+       ++it) {
+    if (it->is_sacked) {
+      sacked_above += get_payload_len(it->msg);
+    } else if (it->is_sent && !it->is_retransmitted &&
+               sacked_above >= 3 * MSS) {
+      mark_lost(sock, *it);
+    }
+  }
+}
+
+/**
+ * Marks the oldest unacknowledged slot as lost, as in classic fast
+ * retransmit.
+ */
+static void mark_head_lost(foggy_socket_t *sock) {
+  if (sock->send_window.empty()) return;
+  send_window_slot_t &slot = sock->send_window.front();
+  if (slot.is_sent && !slot.is_sacked && !slot.is_retransmitted) {
+    mark_lost(sock, slot);
+  }
+}
+
+void process_ack(foggy_socket_t *sock, uint8_t *pkt) {
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)pkt;
+  window_t *win = &sock->window;
+  uint32_t ack = get_ack(hdr);
+  foggy_ack_sample_t rs;
+  struct timespec now;
+
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  memset(&rs, 0, sizeof(rs));
+  rs.rtt_us = -1;
+
+  if (after(ack, win->last_ack_received)) {
+    rs.acked = ack - win->last_ack_received;
+    win->last_ack_received = ack;
+    win->dup_ack_count = 0;
+
+    // Take the RTT and delivery rate samples from the newest slot released
+    // by this ACK. Retransmitted slots are ambiguous and give no RTT sample.
+    while (!sock->send_window.empty()) {
+      send_window_slot_t &slot = sock->send_window.front();
+      foggy_tcp_header_t *slot_hdr = (foggy_tcp_header_t *)slot.msg;
+      uint32_t end = get_seq(slot_hdr) + get_payload_len(slot.msg);
+      if (after(end, ack)) break;
+      if (slot.is_sent && !slot.is_sacked) {
+        win->bytes_in_flight -= get_payload_len(slot.msg);
+        rs.rtt_us = slot.is_rtt_sample
+                        ? timespec_diff_us(&now, &slot.send_time)
+                        : -1;
+        rs.delivery_rate = deliver_slot(sock, slot, &now);
       }
+      uint8_t *msg = slot.msg;
+      sock->send_window.pop_front();
+      free(msg);
     }
+    win->rto_start = now;
+    if (rs.rtt_us >= 0) update_rtt(sock, rs.rtt_us);
+  } else if (ack == win->last_ack_received && get_payload_len(pkt) == 0 &&
+             !sock->send_window.empty()) {
+    rs.is_dup = 1;
+    win->dup_ack_count++;
   }
+
+  handle_extension(sock, pkt);
+  win->advertised_window = (uint32_t)get_advertised_window(hdr)
+                           << win->snd_wscale;
+  if (rs.acked == 0 && !rs.is_dup) return;
+
+  if (win->in_recovery) {
+    if (!rs.is_dup && !before(ack, win->recover)) {
+      win->in_recovery = 0;
+    } else if (!rs.is_dup) {
+      // Partial ACK: the next hole is lost as well.
+      mark_head_lost(sock);
+    }
+  } else if (win->dup_ack_count >= 3 ||
+             (win->sack_ok && !sock->send_window.empty() &&
+              !sock->send_window.front().is_sacked &&
+              sacked_bytes(sock) >= 3 * MSS)) {
+    // Fast retransmit.
+    win->in_recovery = 1;
+    win->recover = win->last_ack_received;
+    for (auto &slot : sock->send_window) {
+      if (!slot.is_sent && !slot.is_retransmitted) break;
+      win->recover = get_seq((foggy_tcp_header_t *)slot.msg) +
+                     get_payload_len(slot.msg);
+    }
+    mark_head_lost(sock);
+    mark_sacked_holes_lost(sock);
+    sock->cc->on_loss(sock);
+    transmit_send_window(sock);
+    return;
+  }
+  if (win->in_recovery) mark_sacked_holes_lost(sock);
+
+  rs.in_recovery = win->in_recovery;
+  rs.in_flight = win->bytes_in_flight;
+  sock->cc->on_ack(sock, &rs);
+  if (win->in_recovery) transmit_send_window(sock);
 }
 
 /**
- * Breaks up the data into packets and sends a single packet at a time.
- *
- * You should most certainly update this function in your implementation.
+ * Breaks up the data into packets and sends as many as the window allows.
  *
  * @param sock The socket to use for sending data.
  * @param data The data to be sent.
@@ -91,7 +616,6 @@ void on_recv_pkt(foggy_socket_t *sock, uint8_t *pkt) {
  */
 void send_pkts(foggy_socket_t *sock, uint8_t *data, int buf_len) {
   uint8_t *data_offset = data;
-  transmit_send_window(sock);
 
   if (buf_len > 0) {
     while (buf_len != 0) {
@@ -99,13 +623,15 @@ void send_pkts(foggy_socket_t *sock, uint8_t *data, int buf_len) {
 
       send_window_slot_t slot;
       slot.is_sent = 0;
+      slot.is_rtt_sample = 1;
+      slot.is_retransmitted = 0;
+      slot.is_sacked = 0;
       slot.msg = create_packet(
           sock->my_port, ntohs(sock->conn.sin_port),
           sock->window.last_byte_sent, sock->window.next_seq_expected,
           sizeof(foggy_tcp_header_t), sizeof(foggy_tcp_header_t) + payload_len,
-          ACK_FLAG_MASK,
-          MAX(MAX_NETWORK_BUFFER - (uint32_t)sock->received_len, MSS), 0, NULL,
-          data_offset, payload_len);
+          ACK_FLAG_MASK, advertised_window_field(sock), 0, NULL, data_offset,
+          payload_len);
       sock->send_window.push_back(slot);
 
       buf_len -= payload_len;
@@ -113,82 +639,383 @@ void send_pkts(foggy_socket_t *sock, uint8_t *data, int buf_len) {
       sock->window.last_byte_sent += payload_len;
     }
   }
-  receive_send_window(sock);
+  // Segments queued during the handshake wait for it to complete.
+  if (sock->state != ESTABLISHED) return;
+  check_retransmit_timeout(sock);
+  transmit_send_window(sock);
 }
 
 
 void add_receive_window(foggy_socket_t *sock, uint8_t *pkt) {
   foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)pkt;
+  uint32_t seq = get_seq(hdr);
+  uint16_t payload_len = get_payload_len(pkt);
+
+  // Drop segments that were already delivered or lie beyond the window.
+  if (before(seq, sock->window.next_seq_expected)) return;
+  if (!before(seq, sock->window.next_seq_expected +
+                       sock->window.recv_buf_size)) {
+    return;
+  }
+  if (sock->ooo_bytes + payload_len > sock->window.recv_buf_size) return;
+  if (sock->receive_window.count(seq) != 0) return;
+
+  if (seq != sock->window.next_seq_expected) sock->window.last_ooo_seq = seq;
+  uint8_t *msg = (uint8_t*) malloc(get_plen(hdr));
+  memcpy(msg, pkt, get_plen(hdr));
+  sock->receive_window[seq] = msg;
+  sock->ooo_bytes += payload_len;
+}
+
+/**
+ * Grows the receive buffer to keep up with the sender (dynamic
+ * right-sizing). The receiver times how long it takes for the right edge of
+ * the advertised window to be filled, which bounds the RTT from above, and
+ * once per such RTT sizes the buffer to twice the data delivered in it so
+ * the sender's window can keep doubling.
+ */
+static void tune_receive_buffer(foggy_socket_t *sock) {
+  window_t *win = &sock->window;
+  struct timespec now;
+
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  if (win->rcv_rtt_time.tv_sec == 0) {
+    win->rcv_rtt_seq = win->next_seq_expected +
+                       ((uint32_t)advertised_window_field(sock)
+                        << win->rcv_wscale);
+    win->rcv_rtt_time = now;
+  } else if (!before(win->next_seq_expected, win->rcv_rtt_seq)) {
+    int64_t sample = timespec_diff_us(&now, &win->rcv_rtt_time);
+    if (win->rcv_rtt_us == 0 || sample < win->rcv_rtt_us) {
+      win->rcv_rtt_us = MAX(sample, (int64_t)1);
+    }
+    win->rcv_rtt_time.tv_sec = 0;
+  }
 
-  // Stop-and-wait implementation
-  // Insert the packet into the first place of receive window
-  receive_window_slot_t *cur_slot = &(sock->receive_window[0]);
-  if (cur_slot->is_used == 0) {
-    cur_slot->is_used = 1;
-    cur_slot->msg = (uint8_t*) malloc(get_plen(hdr));
-    memcpy(cur_slot->msg, pkt, get_plen(hdr));
+  if (win->rcv_rtt_us == 0 ||
+      timespec_diff_us(&now, &win->rcv_space_time) < win->rcv_rtt_us) {
+    return;
+  }
+  uint32_t copied = win->next_seq_expected - win->rcv_space_seq;
+  uint32_t target = 2 * copied + 4 * MSS;
+  if (target > win->recv_buf_size &&
+      win->recv_buf_size < win->max_recv_buf_size) {
+    win->recv_buf_size = MIN(target, win->max_recv_buf_size);
+    debug_printf("Receive buffer grown to %u bytes\n", win->recv_buf_size);
   }
+  win->rcv_space_seq = win->next_seq_expected;
+  win->rcv_space_time = now;
 }
 
 void process_receive_window(foggy_socket_t *sock) {
-  // Stop-and-wait implementation.
-  // Only process the first packet in the window.
-  receive_window_slot_t *cur_slot = &(sock->receive_window[0]);
-  if (cur_slot->is_used != 0) {
-    foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)cur_slot->msg;
-    // Discard unexpected packet
-    if (get_seq(hdr) != sock->window.next_seq_expected) return;
-    // Update next seq number expected
-    uint16_t payload_len = get_payload_len(cur_slot->msg);
-    sock->window.next_seq_expected += payload_len;
-    // Copy to received_buf
-    sock->received_buf = (uint8_t*)
-        realloc(sock->received_buf, sock->received_len + payload_len);
-    memcpy(sock->received_buf + sock->received_len, get_payload(cur_slot->msg),
-           payload_len);
-    sock->received_len += payload_len;
-    // Free the slot
-    cur_slot->is_used = 0;
-    free(cur_slot->msg);
-    cur_slot->msg = NULL;
+  uint32_t delivered = 0;
+
+  // Deliver in-order segments until the next expected one is missing, or the
+  // application has not made room for it yet.
+  while (!sock->receive_window.empty()) {
+    auto it = sock->receive_window.begin();
+    if (after(it->first, sock->window.next_seq_expected)) break;
+    uint8_t *msg = it->second;
+    uint16_t payload_len = get_payload_len(msg);
+    int in_order = it->first == sock->window.next_seq_expected;
+    if (in_order && sock->recv_ring.size - ring_used(&(sock->recv_ring)) <
+                        payload_len) {
+      break;
+    }
+    sock->receive_window.erase(it);
+    sock->ooo_bytes -= payload_len;
+
+    if (in_order) {
+      // Update next seq number expected
+      sock->window.next_seq_expected += payload_len;
+      ring_write(&(sock->recv_ring), get_payload(msg), payload_len);
+      delivered += payload_len;
+    }
+    free(msg);
   }
+  // The peer's FIN counts once everything before it is in.
+  if (sock->peer_fin_pending &&
+      sock->window.next_seq_expected == sock->peer_fin_seq) {
+    sock->window.next_seq_expected++;
+    sock->peer_fin_pending = 0;
+    sock->peer_closed = 1;
+    delivered = 1;
+  }
+  if (delivered > 0) ring_wake(&(sock->recv_ring));
+  tune_receive_buffer(sock);
 }
 
-void transmit_send_window(foggy_socket_t *sock) {
-  if (sock->send_window.empty()) return;
+static int64_t timespec_ns(const struct timespec *ts) {
+  return (int64_t)ts->tv_sec * 1000000000 + ts->tv_nsec;
+}
+
+int enable_txtime(foggy_socket_t *sock) {
+#ifdef SO_TXTIME
+  struct sock_txtime cfg;
+  memset(&cfg, 0, sizeof(cfg));
+  cfg.clockid = CLOCK_MONOTONIC;
+  return setsockopt(sock->socket, SOL_SOCKET, SO_TXTIME, &cfg, sizeof(cfg)) ==
+         0;
+#else
+  (void)sock;
+  return 0;
+#endif
+}
+
+/**
+ * Sends one segment, attaching its departure time when SO_TXTIME is on.
+ */
+static void send_segment(foggy_socket_t *sock, uint8_t *msg, uint16_t plen,
+                         const struct timespec *txtime) {
+#ifdef SO_TXTIME
+  if (sock->txtime) {
+    char control[CMSG_SPACE(sizeof(uint64_t))];
+    struct iovec iov = {msg, plen};
+    struct msghdr mh;
+    uint64_t when = (uint64_t)timespec_ns(txtime);
 
-  // An stop-and-wait implementation. 
-  // For the first slot:
-  // If it has not been sent, send it.
-  // If it has been sent but not ACKed, skip.
-  send_window_slot_t& slot = sock->send_window.front();
-  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)slot.msg;
-  if (slot.is_sent){
+    memset(&mh, 0, sizeof(mh));
+    memset(control, 0, sizeof(control));
+    mh.msg_name = &(sock->conn);
+    mh.msg_namelen = sizeof(sock->conn);
+    mh.msg_iov = &iov;
+    mh.msg_iovlen = 1;
+    mh.msg_control = control;
+    mh.msg_controllen = sizeof(control);
+    struct cmsghdr *cm = CMSG_FIRSTHDR(&mh);
+    cm->cmsg_level = SOL_SOCKET;
+    cm->cmsg_type = SCM_TXTIME;
+    cm->cmsg_len = CMSG_LEN(sizeof(when));
+    memcpy(CMSG_DATA(cm), &when, sizeof(when));
+    sendmsg(sock->socket, &mh, 0);
     return;
-  } else {
-    debug_printf("Sending packet %d %d\n", get_seq(hdr),
-                   get_seq(hdr) + get_payload_len(slot.msg));
-    slot.is_sent = 1;
-    sendto(sock->socket, slot.msg, get_plen(hdr), 0,
-            (struct sockaddr *)&(sock->conn), sizeof(sock->conn));
   }
+#else
+  (void)txtime;
+#endif
+  sendto(sock->socket, msg, plen, 0, (struct sockaddr *)&(sock->conn),
+         sizeof(sock->conn));
 }
 
-void receive_send_window(foggy_socket_t *sock) {
-  // Pop out the packets that have been ACKed
-  while (1) {
-    if (sock->send_window.empty()) break;
+int64_t pacing_delay_ns(foggy_socket_t *sock) {
+  struct timespec now;
 
-    send_window_slot_t slot = sock->send_window.front();
-    foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)slot.msg;
+  if (!sock->pacing || sock->txtime) return 0;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return MAX(timespec_ns(&sock->window.pace_next) - timespec_ns(&now),
+             (int64_t)0);
+}
 
-    if (slot.is_sent == 0) {
-      break;
+/**
+ * Schedules the departure after a segment of `len` bytes leaves at `when`,
+ * so consecutive segments are spaced by len / pacing rate. A backend loop
+ * that comes back a little late may catch up on the lost time, otherwise
+ * every late wakeup would lower the achieved rate.
+ */
+static void pace_segment(foggy_socket_t *sock, const struct timespec *when,
+                         uint16_t len) {
+  uint64_t rate = foggy_cc_pacing_rate(sock);
+  int64_t next = timespec_ns(when);
+  int64_t scheduled = timespec_ns(&sock->window.pace_next);
+
+  if (next - scheduled < PACING_SLACK_NS) next = MIN(next, scheduled);
+  if (rate > 0) next += (int64_t)((uint64_t)len * 1000000000 / rate);
+  sock->window.pace_next.tv_sec = next / 1000000000;
+  sock->window.pace_next.tv_nsec = next % 1000000000;
+}
+
+/**
+ * Records that a slot is leaving now: it counts as in flight and captures
+ * the state its delivery rate sample is measured against.
+ */
+static void mark_sent(foggy_socket_t *sock, send_window_slot_t &slot,
+                      const struct timespec *now) {
+  window_t *win = &sock->window;
+
+  if (win->bytes_in_flight == 0) {
+    win->rto_start = *now;
+    win->delivered_time = *now;
+    win->first_sent_time = *now;
+  }
+  slot.is_sent = 1;
+  slot.send_time = *now;
+  slot.delivered = win->delivered;
+  slot.delivered_time = win->delivered_time;
+  slot.first_sent_time = win->first_sent_time;
+  win->bytes_in_flight += get_payload_len(slot.msg);
+}
+
+/**
+ * Sends the SYN. The window is not scaled in it since the peer has not
+ * agreed to scaling yet.
+ */
+static void send_syn(foggy_socket_t *sock) {
+  uint8_t syn_pkt[MAX_LEN + 3];
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)syn_pkt;
+  window_t *win = &sock->window;
+  uint16_t hlen = sizeof(foggy_tcp_header_t) + 3;
+  uint16_t payload_len = 0;
+  uint32_t free_space = win->recv_buf_size - ring_used(&(sock->recv_ring));
+
+  if (!sock->send_window.empty()) {
+    send_window_slot_t &slot = sock->send_window.front();
+    payload_len = get_payload_len(slot.msg);
+    memcpy(syn_pkt + hlen, get_payload(slot.msg), payload_len);
+    if (slot.is_sent) {
+      slot.is_retransmitted = 1;
+      slot.is_rtt_sample = 0;
+    } else {
+      mark_sent(sock, slot, &sock->syn_time);
+    }
+  }
+
+  debug_printf("Sending SYN %u with %u bytes\n", win->last_ack_received,
+               payload_len);
+  set_header(hdr, sock->my_port, ntohs(sock->conn.sin_port),
+             win->last_ack_received, 0, hlen, hlen + payload_len,
+             SYN_FLAG_MASK, (uint16_t)MIN(free_space, 65535u), 0, NULL);
+  set_extension_length(hdr, 3);
+  get_extension_data(hdr)[0] = EXT_OPT_WSCALE;
+  get_extension_data(hdr)[1] = 1;
+  get_extension_data(hdr)[2] = win->rcv_wscale;
+  sendto(sock->socket, syn_pkt, hlen + payload_len, 0,
+         (struct sockaddr *)&(sock->conn), sizeof(sock->conn));
+}
+
+void check_handshake(foggy_socket_t *sock, int death) {
+  window_t *win = &sock->window;
+  struct timespec now;
+
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  if (!sock->syn_sent) {
+    uint32_t queued = ring_used(&(sock->send_ring));
+    if (sock->syn_data && queued == 0 && !death &&
+        timespec_diff_us(&now, &sock->syn_time) < SYN_DATA_WAIT_US) {
+      return;
+    }
+    // The SYN also carries the 3-byte window scale option.
+    if (sock->syn_data && queued > 0) {
+      int len = MIN(queued, (uint32_t)MSS - 3);
+      uint8_t *data = (uint8_t *)malloc(len);
+      ring_read(&(sock->send_ring), data, len);
+      send_pkts(sock, data, len);
+      free(data);
     }
-    if (has_been_acked(sock, get_seq(hdr)) == 0) {
+    sock->syn_sent = 1;
+    sock->syn_time = now;
+    win->rto_start = now;
+    send_syn(sock);
+    return;
+  }
+
+  if (timespec_diff_us(&now, &win->rto_start) < win->rto_us) return;
+  win->rto_us = MIN(win->rto_us * 2, (int64_t)MAX_RTO_US);
+  win->rto_start = now;
+  sock->syn_retransmitted = 1;
+  sock->syn_time = now;
+  send_syn(sock);
+}
+
+/**
+ * Sends a FIN after the last byte sent.
+ */
+static void send_fin(foggy_socket_t *sock) {
+  uint8_t fin_pkt[sizeof(foggy_tcp_header_t)];
+  foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)fin_pkt;
+  uint16_t hlen = sizeof(foggy_tcp_header_t);
+
+  debug_printf("Sending FIN %u\n", sock->window.last_byte_sent);
+  set_header(hdr, sock->my_port, ntohs(sock->conn.sin_port),
+             sock->window.last_byte_sent, sock->window.next_seq_expected, hlen,
+             hlen, FIN_FLAG_MASK | ACK_FLAG_MASK,
+             advertised_window_field(sock), 0, NULL);
+  set_extension_length(hdr, 0);
+  sendto(sock->socket, fin_pkt, hlen, 0, (struct sockaddr *)&(sock->conn),
+         sizeof(sock->conn));
+  sock->window.ack_pending = 0;
+}
+
+int check_close(foggy_socket_t *sock) {
+  window_t *win = &sock->window;
+  struct timespec now;
+
+  // Without a connection there is nobody to say goodbye to.
+  if (sock->state != ESTABLISHED) return 1;
+
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  if (!sock->fin_sent) {
+    sock->fin_sent = 1;
+    sock->fin_time = now;
+    win->rto_start = now;
+    send_fin(sock);
+    return 0;
+  }
+  if (sock->fin_acked && sock->peer_closed) return 1;
+  if (timespec_diff_us(&now, &sock->fin_time) >=
+      (int64_t)sock->linger_ms * 1000) {
+    debug_printf("Linger expired\n");
+    return 1;
+  }
+  if (!sock->fin_acked &&
+      timespec_diff_us(&now, &win->rto_start) >= win->rto_us) {
+    win->rto_us = MIN(win->rto_us * 2, (int64_t)MAX_RTO_US);
+    win->rto_start = now;
+    send_fin(sock);
+  }
+  return 0;
+}
+
+void transmit_send_window(foggy_socket_t *sock) {
+  window_t *win = &sock->window;
+  uint32_t wnd = MIN(win->congestion_window, win->advertised_window);
+  struct timespec now, depart;
+
+  // Send every unsent slot that fits in min(cwnd, rwnd). A single segment is
+  // always allowed when nothing is in flight so the connection cannot stall.
+  for (auto &slot : sock->send_window) {
+    if (slot.is_sent) continue;
+    foggy_tcp_header_t *hdr = (foggy_tcp_header_t *)slot.msg;
+    uint16_t payload_len = get_payload_len(slot.msg);
+    if (win->bytes_in_flight > 0 && win->bytes_in_flight + payload_len > wnd) {
       break;
     }
-    sock->send_window.pop_front();
-    free(slot.msg);
+
+    // The pacer spaces segments at the pacing rate. Without SO_TXTIME the
+    // rest of the window waits here for the backend loop to come back;
+    // with it, each segment is stamped with its departure time instead.
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    depart = now;
+    if (sock->pacing && timespec_ns(&win->pace_next) > timespec_ns(&now)) {
+      if (!sock->txtime) break;
+      depart = win->pace_next;
+    }
+
+    debug_printf("%s packet %d %d\n",
+                 slot.is_retransmitted ? "Retransmitting" : "Sending",
+                 get_seq(hdr), get_seq(hdr) + payload_len);
+    mark_sent(sock, slot, &now);
+    if (sock->pacing) pace_segment(sock, &depart, get_plen(hdr));
+    send_segment(sock, slot.msg, get_plen(hdr), &depart);
+  }
+}
+
+void check_retransmit_timeout(foggy_socket_t *sock) {
+  window_t *win = &sock->window;
+  struct timespec now;
+
+  if (sock->state != ESTABLISHED || win->bytes_in_flight == 0) return;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  if (timespec_diff_us(&now, &win->rto_start) < win->rto_us) return;
+
+  // Everything in flight that was not sacked is presumed lost and goes out
+  // again as the window reopens. Exponential backoff per RFC 6298.
+  debug_printf("Retransmission timeout, RTO %ld us\n", (long)win->rto_us);
+  for (auto &slot : sock->send_window) {
+    if (slot.is_sent && !slot.is_sacked) mark_lost(sock, slot);
   }
+  win->bytes_in_flight = 0;
+  win->in_recovery = 0;
+  win->dup_ack_count = 0;
+  win->rto_us = MIN(win->rto_us * 2, (int64_t)MAX_RTO_US);
+  sock->cc->on_timeout(sock);
 }
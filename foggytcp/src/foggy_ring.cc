@@ -0,0 +1,92 @@
+/* Copyright (C) 2024 Hong Kong University of Science and Technology
+
+This repository is used for the Computer Networks (ELEC 3120)
+course taught at Hong Kong University of Science and Technology.
+
+No part of the project may be copied and/or distributed without
+the express permission of the course staff. Everyone is prohibited
+from releasing their forks in any public places. */
+
+/*
+ * This file implements the single-producer/single-consumer byte rings used
+ * between the application and the backend.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+
+#include "foggy_ring.h"
+
+#define MIN(X, Y) (((X) < (Y)) ? (X) : (Y))
+
+void ring_init(foggy_ring_t* ring, uint32_t size) {
+  ring->buf = (uint8_t*)malloc(size);
+  ring->size = size;
+  ring->head.store(0);
+  ring->tail.store(0);
+  ring->waiting.store(0);
+  pthread_mutex_init(&(ring->lock), NULL);
+  pthread_cond_init(&(ring->cond), NULL);
+}
+
+void ring_free(foggy_ring_t* ring) {
+  free(ring->buf);
+  ring->buf = NULL;
+  pthread_mutex_destroy(&(ring->lock));
+  pthread_cond_destroy(&(ring->cond));
+}
+
+uint32_t ring_used(foggy_ring_t* ring) {
+  uint64_t head = ring->head.load(std::memory_order_acquire);
+  return (uint32_t)(ring->tail.load(std::memory_order_acquire) - head);
+}
+
+uint32_t ring_write(foggy_ring_t* ring, const uint8_t* data, uint32_t len) {
+  uint64_t tail = ring->tail.load(std::memory_order_relaxed);
+  uint64_t head = ring->head.load(std::memory_order_acquire);
+  uint32_t n = MIN(len, ring->size - (uint32_t)(tail - head));
+  uint32_t off = (uint32_t)(tail % ring->size);
+  uint32_t first = MIN(n, ring->size - off);
+
+  memcpy(ring->buf + off, data, first);
+  memcpy(ring->buf, data + first, n - first);
+  ring->tail.store(tail + n, std::memory_order_release);
+  return n;
+}
+
+uint32_t ring_read(foggy_ring_t* ring, uint8_t* data, uint32_t len) {
+  uint64_t head = ring->head.load(std::memory_order_relaxed);
+  uint64_t tail = ring->tail.load(std::memory_order_acquire);
+  uint32_t n = MIN(len, (uint32_t)(tail - head));
+  uint32_t off = (uint32_t)(head % ring->size);
+  uint32_t first = MIN(n, ring->size - off);
+
+  memcpy(data, ring->buf + off, first);
+  memcpy(data + first, ring->buf, n - first);
+  ring->head.store(head + n, std::memory_order_release);
+  return n;
+}
+
+void ring_wait(foggy_ring_t* ring, int (*ready)(void*), void* arg) {
+  if (ready(arg)) return;
+
+  pthread_mutex_lock(&(ring->lock));
+  // Pairs with the fence in ring_wake: either the waker sees `waiting` or we
+  // see its update in `ready`.
+  ring->waiting.store(1);
+  std::atomic_thread_fence(std::memory_order_seq_cst);
+  while (!ready(arg)) {
+    pthread_cond_wait(&(ring->cond), &(ring->lock));
+  }
+  ring->waiting.store(0);
+  pthread_mutex_unlock(&(ring->lock));
+}
+
+void ring_wake(foggy_ring_t* ring) {
+  std::atomic_thread_fence(std::memory_order_seq_cst);
+  if (ring->waiting.load(std::memory_order_relaxed)) {
+    pthread_mutex_lock(&(ring->lock));
+    pthread_cond_signal(&(ring->cond));
+    pthread_mutex_unlock(&(ring->lock));
+  }
+}
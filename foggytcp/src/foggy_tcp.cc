@@ -21,60 +21,197 @@ from releasing their forks in any public places. */
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/random.h>
 #include <sys/socket.h>
 #include <unistd.h>
 
 #include "foggy_backend.h"
+#include "foggy_cc.h"
+#include "foggy_function.h"
 
-void* foggy_socket(const foggy_socket_type_t socket_type,
-               const char *server_port, const char *server_ip) {
-  foggy_socket_t* sock = new foggy_socket_t;
-  int sockfd, optval;
-  socklen_t len;
-  struct sockaddr_in conn, my_addr;
-  len = sizeof(my_addr);
+/**
+ * Reads an on/off socket option from the environment.
+ *
+ * @param name The environment variable.
+ * @param default_value The value used when the variable is unset.
+ *
+ * @return 0 if the variable is "0", 1 if it is set to anything else.
+ */
+static int env_flag(const char *name, int default_value) {
+  const char *value = getenv(name);
+  if (value == NULL || value[0] == '\0') return default_value;
+  return strcmp(value, "0") != 0;
+}
 
-  sockfd = socket(AF_INET, SOCK_DGRAM, 0);
-  if (sockfd < 0) {
-    perror("ERROR opening socket");
-    return NULL;
-  }
-  sock->socket = sockfd;
-  // sock->state = CLOSED;
-  sock->received_buf = NULL;
-  sock->received_len = 0;
-  pthread_mutex_init(&(sock->recv_lock), NULL);
+/**
+ * Reads a positive integer socket option from the environment.
+ *
+ * @param name The environment variable.
+ * @param default_value The value used when the variable is unset or invalid.
+ *
+ * @return The value of the option.
+ */
+static int env_int(const char *name, int default_value) {
+  const char *value = getenv(name);
+  if (value == NULL || atoi(value) <= 0) return default_value;
+  return atoi(value);
+}
 
-  sock->sending_buf = NULL;
-  sock->sending_len = 0;
-  pthread_mutex_init(&(sock->send_lock), NULL);
+/**
+ * Picks a random initial sequence number.
+ *
+ * @return The initial sequence number.
+ */
+static uint32_t random_isn() {
+  uint32_t isn;
+  struct timespec now;
+
+  if (getrandom(&isn, sizeof(isn), 0) == (ssize_t)sizeof(isn)) return isn;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint32_t)(now.tv_nsec ^ (now.tv_sec << 20) ^ getpid());
+}
+
+/**
+ * Initializes everything about a socket except its UDP socket and addresses.
+ *
+ * @param sock The socket.
+ * @param socket_type Whether the socket initiates or accepts the handshake.
+ */
+static void init_socket_state(foggy_socket_t *sock,
+                              foggy_socket_type_t socket_type) {
+  sock->state = socket_type == TCP_INITIATOR ? SYN_SENT : LISTEN;
+  sock->syn_data = env_flag("FOGGY_SYN_DATA", 1);
+  sock->syn_sent = 0;
+  sock->syn_retransmitted = 0;
+  clock_gettime(CLOCK_MONOTONIC, &(sock->syn_time));
+  sock->linger_ms = env_int("FOGGY_LINGER_MS", DEFAULT_LINGER_MS);
+  sock->fin_sent = 0;
+  sock->fin_acked = 0;
+  sock->peer_fin_pending = 0;
+  sock->peer_fin_seq = 0;
+  sock->peer_closed = 0;
+
+  // The send ring holds at most FOGGY_SNDBUF bytes. foggy_write blocks while
+  // queued plus unacknowledged data would exceed it.
+  sock->send_buf_size = env_int("FOGGY_SNDBUF", DEFAULT_SEND_BUFFER);
+  ring_init(&(sock->send_ring), sock->send_buf_size);
+  sock->unacked_len = 0;
+  sock->nagle = env_flag("FOGGY_NAGLE", 1);
+  sock->nagle_start.tv_sec = 0;
+  sock->nagle_start.tv_nsec = 0;
 
   sock->type = socket_type;
   sock->dying = 0;
-  pthread_mutex_init(&(sock->death_lock), NULL);
 
-  // FIXME: Sequence numbers should be randomly initialized. The next expected
-  // sequence number should be initialized according to the SYN packet from the
-  // other side of the connection.
-  sock->window.last_byte_sent = 0;
-  sock->window.last_ack_received = 0;
+  sock->split_threads = env_flag("FOGGY_SPLIT_THREADS", 0);
+  sock->rx_cpu = env_int("FOGGY_RX_CPU", -1);
+  sock->tx_cpu = env_int("FOGGY_TX_CPU", -1);
+  pthread_mutex_init(&(sock->window_lock), NULL);
+  sock->tx_done = 0;
+  sock->tx_kicked = 0;
+  sock->tx_waiting = 0;
+  pthread_mutex_init(&(sock->tx_lock), NULL);
+  pthread_cond_init(&(sock->tx_cond), NULL);
+
+  // The initial sequence number is random. The next expected sequence number
+  // is taken from the peer's SYN or SYN-ACK.
+  uint32_t isn = random_isn();
+  sock->window.last_byte_sent = isn;
+  sock->window.last_ack_received = isn;
   sock->window.dup_ack_count = 0;
   sock->window.next_seq_expected = 0;
   sock->window.ssthresh = WINDOW_INITIAL_SSTHRESH;
   sock->window.advertised_window = WINDOW_INITIAL_ADVERTISED;
   sock->window.congestion_window = WINDOW_INITIAL_WINDOW_SIZE;
   sock->window.reno_state = RENO_SLOW_START;
-  pthread_mutex_init(&(sock->window.ack_lock), NULL);
+  sock->window.bytes_in_flight = 0;
+  sock->window.in_recovery = 0;
+  sock->window.recover = 0;
+  sock->window.sack_ok = 0;
+  sock->window.last_ooo_seq = 0;
+  sock->window.ack_pending = 0;
+  sock->delayed_ack = env_flag("FOGGY_DELAYED_ACK", 1);
+  sock->pacing = env_flag("FOGGY_PACING", 1);
+  sock->txtime = 0;
+  sock->window.pace_next.tv_sec = 0;
+  sock->window.pace_next.tv_nsec = 0;
+  sock->window.srtt_us = 0;
+  sock->window.rttvar_us = 0;
+  sock->window.rto_us = (int64_t)WINDOW_INITIAL_RTT * 1000;
+  sock->window.delivered = 0;
+  clock_gettime(CLOCK_MONOTONIC, &(sock->window.rto_start));
+  sock->window.delivered_time = sock->window.rto_start;
+  sock->window.first_sent_time = sock->window.rto_start;
+
+  // The congestion control is picked per socket from FOGGY_CCA (reno, cubic
+  // or bbr) so the same binary can be benchmarked with each algorithm.
+  const foggy_cc_ops_t *cc = foggy_cc_find(getenv("FOGGY_CCA"));
+  if (cc == NULL) {
+    fprintf(stderr, "Unknown congestion control \"%s\", using reno\n",
+            getenv("FOGGY_CCA"));
+    cc = &foggy_cc_reno;
+  }
+  foggy_cc_attach(sock, cc);
 
-  for (int i = 0; i < RECEIVE_WINDOW_SLOT_SIZE; ++i) {
-    sock->receive_window[i].is_used = 0;
-    sock->receive_window[i].msg = NULL;
+  sock->ooo_bytes = 0;
+
+  // The window scale is fixed by the largest buffer we may grow to, so the
+  // 16-bit advertised window field can always express it.
+  sock->window.recv_buf_size = MAX_NETWORK_BUFFER;
+  sock->window.max_recv_buf_size =
+      env_int("FOGGY_RCVBUF_MAX", DEFAULT_MAX_RECEIVE_BUFFER);
+  if (sock->window.max_recv_buf_size < MAX_NETWORK_BUFFER) {
+    sock->window.max_recv_buf_size = MAX_NETWORK_BUFFER;
+  }
+  sock->window.rcv_wscale = 0;
+  while ((sock->window.max_recv_buf_size >> sock->window.rcv_wscale) > 65535) {
+    sock->window.rcv_wscale++;
   }
+  sock->window.snd_wscale = 0;
+  sock->window.rcv_rtt_us = 0;
+  sock->window.rcv_rtt_time.tv_sec = 0;
+  sock->window.rcv_space_seq = 0;
+  clock_gettime(CLOCK_MONOTONIC, &(sock->window.rcv_space_time));
+  // Unread data counts against the advertised window, so the ring never
+  // needs to hold more than the largest receive buffer.
+  ring_init(&(sock->recv_ring), sock->window.max_recv_buf_size);
+
+  sock->listener = NULL;
+  pthread_mutex_init(&(sock->accept_lock), NULL);
+  pthread_cond_init(&(sock->accept_cond), NULL);
+  sock->implicit_conn = NULL;
+  sock->accepted = 0;
+  sock->finished = 0;
+}
+
+/**
+ * Releases everything a socket owns except its UDP socket.
+ *
+ * @param sock The socket.
+ */
+static void free_socket_state(foggy_socket_t *sock) {
+  foggy_cc_detach(sock);
+  ring_free(&(sock->recv_ring));
+  ring_free(&(sock->send_ring));
+  for (auto &slot : sock->send_window) free(slot.msg);
+  for (auto &entry : sock->receive_window) free(entry.second);
+}
+
+void* foggy_socket(const foggy_socket_type_t socket_type,
+               const char *server_port, const char *server_ip) {
+  foggy_socket_t* sock = new foggy_socket_t;
+  int sockfd, optval;
+  socklen_t len;
+  struct sockaddr_in conn, my_addr;
+  len = sizeof(my_addr);
 
-  if (pthread_cond_init(&sock->wait_cond, NULL) != 0) {
-    perror("ERROR condition variable not set\n");
+  sockfd = socket(AF_INET, SOCK_DGRAM, 0);
+  if (sockfd < 0) {
+    perror("ERROR opening socket");
     return NULL;
   }
+  sock->socket = sockfd;
+  init_socket_state(sock, socket_type);
 
   uint16_t portno = (uint16_t)atoi(server_port);
   switch (socket_type) {
@@ -123,84 +260,178 @@ void* foggy_socket(const foggy_socket_type_t socket_type,
   getsockname(sockfd, (struct sockaddr *)&my_addr, &len);
   sock->my_port = ntohs(my_addr.sin_port);
 
+  // SO_TXTIME moves pacing into the qdisc (it needs fq or etf on the
+  // egress interface); without kernel support the backend paces itself.
+  if (sock->pacing && env_flag("FOGGY_TXTIME", 0)) {
+    sock->txtime = enable_txtime(sock);
+    if (!sock->txtime) {
+      perror("SO_TXTIME unavailable, pacing in the backend");
+    }
+  }
+
   pthread_create(&(sock->thread_id), NULL, begin_backend, (void *)sock);
   return (void*)sock;
 }
 
-int foggy_close(void *in_sock) {
+foggy_socket_t* foggy_new_connection(foggy_socket_t *listener,
+                                     const struct sockaddr_in *peer) {
+  foggy_socket_t *sock = new foggy_socket_t;
+
+  init_socket_state(sock, TCP_LISTENER);
+  sock->socket = listener->socket;
+  sock->conn = *peer;
+  sock->my_port = listener->my_port;
+  sock->txtime = listener->txtime;
+  // The listener's backend thread drives every child.
+  sock->split_threads = 0;
+  sock->listener = listener;
+
+  pthread_mutex_lock(&(listener->accept_lock));
+  listener->accept_queue.push_back(sock);
+  pthread_cond_broadcast(&(listener->accept_cond));
+  pthread_mutex_unlock(&(listener->accept_lock));
+  return sock;
+}
+
+void foggy_finish_connection(foggy_socket_t *sock) {
+  foggy_socket_t *listener = sock->listener;
+
+  pthread_mutex_lock(&(listener->accept_lock));
+  if (!sock->accepted) {
+    for (auto it = listener->accept_queue.begin();
+         it != listener->accept_queue.end(); ++it) {
+      if (*it == sock) {
+        listener->accept_queue.erase(it);
+        break;
+      }
+    }
+    pthread_mutex_unlock(&(listener->accept_lock));
+    free_socket_state(sock);
+    delete sock;
+    return;
+  }
+  sock->finished = 1;
+  pthread_cond_broadcast(&(listener->accept_cond));
+  pthread_mutex_unlock(&(listener->accept_lock));
+}
+
+void* foggy_accept(void *in_sock) {
   struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;
-  while (pthread_mutex_lock(&(sock->death_lock)) != 0) {
+  foggy_socket_t *conn = NULL;
+
+  if (sock->type != TCP_LISTENER || sock->listener != NULL) return NULL;
+
+  pthread_mutex_lock(&(sock->accept_lock));
+  while (sock->accept_queue.empty() && !sock->dying) {
+    pthread_cond_wait(&(sock->accept_cond), &(sock->accept_lock));
   }
-  sock->dying = 1;
-  pthread_mutex_unlock(&(sock->death_lock));
+  if (!sock->accept_queue.empty()) {
+    conn = sock->accept_queue.front();
+    sock->accept_queue.pop_front();
+    conn->accepted = 1;
+  }
+  pthread_mutex_unlock(&(sock->accept_lock));
+  return (void*)conn;
+}
 
-  pthread_join(sock->thread_id, NULL);
+/**
+ * Gets the connection a read or write applies to. On a listener that is the
+ * first accepted connection, as listeners used to serve a single peer.
+ */
+static foggy_socket_t* connection_of(void *in_sock) {
+  struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;
 
-  if (sock != NULL) {
-    if (sock->received_buf != NULL) {
-      free(sock->received_buf);
-    }
-    if (sock->sending_buf != NULL) {
-      free(sock->sending_buf);
-    }
-  } else {
+  if (sock->type != TCP_LISTENER || sock->listener != NULL) return sock;
+  if (sock->implicit_conn == NULL) {
+    sock->implicit_conn = (foggy_socket_t *)foggy_accept(sock);
+  }
+  return sock->implicit_conn;
+}
+
+int foggy_close(void *in_sock) {
+  struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;
+
+  if (sock == NULL) {
     perror("ERROR null socket\n");
     return EXIT_ERROR;
   }
+
+  // A child is torn down by the listener's backend; wait for it to finish.
+  if (sock->listener != NULL) {
+    foggy_socket_t *listener = sock->listener;
+    sock->dying = 1;
+    pthread_mutex_lock(&(listener->accept_lock));
+    while (!sock->finished) {
+      pthread_cond_wait(&(listener->accept_cond), &(listener->accept_lock));
+    }
+    pthread_mutex_unlock(&(listener->accept_lock));
+    free_socket_state(sock);
+    delete sock;
+    return EXIT_SUCCESS;
+  }
+
+  if (sock->implicit_conn != NULL) foggy_close(sock->implicit_conn);
+
+  pthread_mutex_lock(&(sock->accept_lock));
+  sock->dying = 1;
+  pthread_cond_broadcast(&(sock->accept_cond));
+  pthread_mutex_unlock(&(sock->accept_lock));
+
+  pthread_join(sock->thread_id, NULL);
+
+  free_socket_state(sock);
   return close(sock->socket);
 }
 
+static int can_read(void *in_sock) {
+  struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;
+  return ring_used(&(sock->recv_ring)) > 0 || sock->peer_closed;
+}
+
+static int can_write(void *in_sock) {
+  struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;
+  return (int)ring_used(&(sock->send_ring)) + sock->unacked_len <
+         sock->send_buf_size;
+}
+
 int foggy_read(void* in_sock, void *buf, int length) {
-  struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;  
-  uint8_t *new_buf;
-  int read_len = 0;
+  struct foggy_socket_t *sock = connection_of(in_sock);
 
   if (length < 0) {
     perror("ERROR negative length");
     return EXIT_ERROR;
   }
 
-  while (pthread_mutex_lock(&(sock->recv_lock)) != 0) {
-  }
-
-  while (sock->received_len == 0) {
-    pthread_cond_wait(&(sock->wait_cond), &(sock->recv_lock));
-  }
-  if (sock->received_len > 0) {
-    if (sock->received_len > length)
-      read_len = length;
-    else
-      read_len = sock->received_len;
-
-    memcpy(buf, sock->received_buf, read_len);
-    if (read_len < sock->received_len) {
-      new_buf = (uint8_t*) malloc(sock->received_len - read_len);
-      memcpy(new_buf, sock->received_buf + read_len,
-              sock->received_len - read_len);
-      free(sock->received_buf);
-      sock->received_len -= read_len;
-      sock->received_buf = new_buf;
-    } else {
-      free(sock->received_buf);
-      sock->received_buf = NULL;
-      sock->received_len = 0;
-    }
-  }
-  pthread_mutex_unlock(&(sock->recv_lock));
-  return read_len;
+  // Returns 0 at end of stream, once the peer's FIN and all data before it
+  // have been read.
+  ring_wait(&(sock->recv_ring), can_read, sock);
+  return (int)ring_read(&(sock->recv_ring), (uint8_t *)buf, length);
 }
 
 int foggy_write(void *in_sock, const void *buf, int length) {
-  struct foggy_socket_t *sock = (struct foggy_socket_t *)in_sock;
-  while (pthread_mutex_lock(&(sock->send_lock)) != 0) {
+  struct foggy_socket_t *sock = connection_of(in_sock);
+  const uint8_t *data = (const uint8_t *)buf;
+  int space, chunk;
+
+  if (length < 0) {
+    perror("ERROR negative length");
+    return EXIT_ERROR;
+  }
+
+  // Copy as much as fits and wait for ACKs to free room for the rest, so a
+  // large write streams through a bounded buffer.
+  while (length > 0) {
+    space = sock->send_buf_size - (int)ring_used(&(sock->send_ring)) -
+            sock->unacked_len;
+    if (space <= 0) {
+      ring_wait(&(sock->send_ring), can_write, sock);
+      continue;
+    }
+    chunk = length < space ? length : space;
+    chunk = ring_write(&(sock->send_ring), data, chunk);
+    data += chunk;
+    length -= chunk;
+    backend_kick(sock);
   }
-  if (sock->sending_buf == NULL)
-    sock->sending_buf = (uint8_t*) malloc(length);
-  else
-    sock->sending_buf = (uint8_t*) realloc(sock->sending_buf, length + sock->sending_len);
-  memcpy(sock->sending_buf + sock->sending_len, buf, length);
-  sock->sending_len += length;
-
-  pthread_mutex_unlock(&(sock->send_lock));
   return EXIT_SUCCESS;
 }
@@ -52,6 +52,7 @@ int main(int argc, const char* argv[]) {
 
   char buf[BUF_SIZE + sizeof(struct timespec)];
   bool first_packet = true;
+  struct timespec end_time;
   
   while (true) {
     /* Read data from the socket into the buffer. The amount of data read is
@@ -61,6 +62,9 @@ int main(int argc, const char* argv[]) {
     int bytes_read = foggy_read(sock, buf, BUF_SIZE + sizeof(struct timespec));
     if (bytes_read <= 0)
       break;
+    /* The transfer ends with the last byte, not with the peer's FIN that
+     * follows it one round trip later */
+    timespec_get(&end_time, TIME_UTC);
 
     if (first_packet) {
       /* Extract start time from first packet */
@@ -82,9 +86,6 @@ int main(int argc, const char* argv[]) {
     }
   }
 
-  struct timespec end_time;
-  timespec_get(&end_time, TIME_UTC);
-
   /* Close the socket and the output file */
   foggy_close(sock);
   ofs.close();
@@ -5,5 +5,11 @@ os.system('zip -j submit.zip \
           .git/CUR_COMMIT \
           foggytcp/src/foggy_function.cc \
           foggytcp/src/foggy_tcp.cc \
+          foggytcp/src/foggy_cc.cc \
+          foggytcp/src/foggy_cubic.cc \
+          foggytcp/src/foggy_bbr.cc \
+          foggytcp/src/foggy_ring.cc \
           foggytcp/inc/foggy_function.h \
-          foggytcp/inc/foggy_tcp.h')
+          foggytcp/inc/foggy_tcp.h \
+          foggytcp/inc/foggy_cc.h \
+          foggytcp/inc/foggy_ring.h')